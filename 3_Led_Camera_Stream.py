@@ -1,8 +1,9 @@
 import cv2
 import requests
-import numpy as np
 import threading
 
+from selfdriving.car import FrameSource
+
 # ESP32-CAM configuration
 ESP32_IP = "192.168.4.1"  # Replace with your ESP32 IP address
 STREAM_URL = f"http://{ESP32_IP}:80/stream"  # Video Stream URL (Port 80)
@@ -42,46 +43,29 @@ def control_commands():
 # Function for streaming video
 def video_stream():
     print("Starting video stream...")
-    try:
-        stream = requests.get(STREAM_URL, stream=True)
-        if stream.status_code != 200:
-            print(f"Error: Failed to connect to the stream at {STREAM_URL}")
-            return
-    except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
+    # Connects on the first get(), decodes only the newest frame and flips it upside down
+    camera = FrameSource(STREAM_URL, flip=-1)
+    if camera.get(timeout=5) is None:
+        print(f"Error: Failed to connect to the stream at {STREAM_URL}")
+        camera.close()
         return
 
-    bytes_buffer = b''
-
     print("Press 'Ctrl+C' to quit the video stream.")
 
+    frame = None
     try:
-        for chunk in stream.iter_content(chunk_size=1024):
-            bytes_buffer += chunk
-            start = bytes_buffer.find(b'\xff\xd8')  # JPEG start
-            end = bytes_buffer.find(b'\xff\xd9')    # JPEG end
-
-            if start != -1 and end != -1:
-                jpg = bytes_buffer[start:end + 2]
-                bytes_buffer = bytes_buffer[end + 2:]
-
-                try:
-                    img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
-                    if img is None:
-                        raise ValueError("Empty frame received.")
-                except Exception as e:
-                    continue  # Skip invalid frame
-
-                img = cv2.resize(img, (800, 600))
-                img = cv2.flip(img, -1)
-                cv2.imshow('ESP32-CAM Stream', img)
-
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
+        while True:
+            new_frame = camera.get(after=frame.seq if frame else 0, timeout=0.1)
+            if new_frame is not None:
+                frame = new_frame
+                cv2.imshow('ESP32-CAM Stream', cv2.resize(frame.image, (800, 600)))
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
     except Exception as e:
         print(f"Error: {e}")
 
-    stream.close()
+    camera.close()
     cv2.destroyAllWindows()
 
 # Threading to run video stream and control commands simultaneously
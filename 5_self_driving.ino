@@ -51,6 +51,21 @@ const int8_t CMD_STOP = 0;
 const int8_t CMD_FWD  = 1;  
 const int8_t CMD_TURN = 2;  
   
+// ——— Framed protocol v1 (host side: selfdriving/protocol.py) ———  
+// [0xA5][ver][type][flags][seq:2][host ms:4][cmd][steer:2][throttle:2][xor]  
+// Legacy 3-byte [cmd][value:2] packets still work; they never start with 0xA5.  
+const uint8_t PROTO_MAGIC   = 0xA5;  
+const uint8_t PROTO_VERSION = 1;  
+const uint8_t MSG_COMMAND   = 1;  
+const uint8_t MSG_HEARTBEAT = 2;  
+const uint8_t MSG_ACK       = 3;  
+const uint8_t FLAG_ACK      = 0x01;  // Host wants an ACK with our receive time  
+const uint8_t FLAG_THROTTLE = 0x02;  // Throttle field is set  
+const int FRAME_LEN  = 16;  
+const int ACK_LEN    = 15;  
+const int LEGACY_LEN = 3;  
+const uint32_t WATCHDOG_MS = 500;  // Stop if a framed client goes quiet this long  
+  
 // ——— Movement Speed ———  
 const int16_t BASE_SPEED = 60;  
 const int16_t MAX_SPEED  = 100;  
@@ -183,62 +198,146 @@ void setup() {
   start_stream_server();  
 }  
   
+uint8_t xorChecksum(const uint8_t *data, int len) {  
+  uint8_t value = 0;  
+  for (int i = 0; i < len; i++) value ^= data[i];  
+  return value;  
+}  
+  
+void sendAck(const uint8_t *frame, uint32_t receivedMicros) {  
+  // Same header as the frame, host timestamp echoed, our receive time instead of the command  
+  uint8_t ack[ACK_LEN];  
+  ack[0] = PROTO_MAGIC;  
+  ack[1] = PROTO_VERSION;  
+  ack[2] = MSG_ACK;  
+  ack[3] = 0;  
+  memcpy(ack + 4, frame + 4, 6);  // seq + host ms  
+  ack[10] = receivedMicros >> 24;  
+  ack[11] = receivedMicros >> 16;  
+  ack[12] = receivedMicros >> 8;  
+  ack[13] = receivedMicros;  
+  ack[14] = xorChecksum(ack, ACK_LEN - 1);  
+  client.write(ack, ACK_LEN);  
+}  
+  
+void applyCommand(int8_t cmd, int16_t value, bool hasThrottle, int16_t throttle) {  
+  int16_t leftPwr  = 0, rightPwr = 0;  
+  int leftDir = CCW, rightDir = CCW;  
+  // Power for driving straight: the throttle if the host sent one, else as before  
+  int16_t straightPwr = hasThrottle ? scaledPower(throttle) : BASE_SPEED;  
+  
+  if (hasThrottle && throttle <= 0) {  
+    cmd = CMD_STOP;  
+  }  
+  
+  switch (cmd) {  
+    case CMD_STOP:  
+      robot.brake(1);  
+      robot.brake(2);  
+      return;  
+  
+    case CMD_FWD:  
+      leftPwr = rightPwr = hasThrottle ? straightPwr : scaledPower(BASE_SPEED);  //abs(value)
+      break;  
+  
+    case CMD_TURN:  
+
+      if (value > -15 && value < 15) {
+        leftPwr  = straightPwr;
+        rightPwr = straightPwr;
+        leftDir  = CCW;
+        rightDir = CCW;
+      }
+      else if (value > 0) {
+        leftPwr = scaledPower(abs(value));  
+        rightPwr = 0;  // stop
+        leftDir = CCW;   // Forward  
+        rightDir = CW;   // Backward  
+      }
+      else {  // value < 0
+        leftPwr = 0;  // stop
+        rightPwr = scaledPower(abs(value));  
+        leftDir = CW;    // Backward  
+        rightDir = CCW;  // Forward  
+      }
+      
+      break;  
+
+    default:  
+      return;  
+  }  
+  
+  robot.rotate(1, leftPwr, leftDir);  
+  robot.rotate(2, rightPwr, rightDir);  
+}  
+  
 // ——— Loop ———  
 void loop() {  
+  static bool framedClient = false;  // Sent at least one v1 frame: watchdog is active  
+  static uint32_t lastFrameMs = 0;  
+  static bool watchdogStopped = false;  // Stopped by the watchdog, not by a command  
+  
   // Accept client  
   if (!client || !client.connected()) {  
+    if (framedClient) {  
+      // Host went away mid-drive: stop instead of running its last command forever  
+      applyCommand(CMD_STOP, 0, false, 0);  
+      framedClient = false;  
+    }  
     client = server.available();  
   }  
   
-  // Read and process binary commands  
-  const int PKT = 3;  
-  static uint8_t buf[PKT];  
-  
-  while (client && client.available() >= PKT) {  
-    client.read(buf, PKT);  
-    int8_t cmd = buf[0];  
-    int16_t value = (buf[1] << 8) | buf[2];  
+  // Drain everything that is waiting and act only on the newest command  
+  bool haveCmd = false;  
+  bool hasThrottle = false;  
+  int8_t cmd = CMD_STOP;  
+  int16_t value = 0, throttle = 0;  
+  static uint8_t buf[FRAME_LEN];  
   
-    int16_t leftPwr  = 0, rightPwr = 0;  
-    int leftDir = CCW, rightDir = CCW;  
-  
-    switch (cmd) {  
-      case CMD_STOP:  
-        robot.brake(1);  
-        robot.brake(2);  
-        break;  
-  
-      case CMD_FWD:  
-        leftPwr = rightPwr = scaledPower(BASE_SPEED);  //abs(value)
-        break;  
-  
-      case CMD_TURN:  
-
-        if (value > -15 && value < 15) {
-          leftPwr  = BASE_SPEED;
-          rightPwr = BASE_SPEED;
-          leftDir  = CCW;
-          rightDir = CCW;
-        }
-        else if (value > 0) {
-          leftPwr = scaledPower(abs(value));  
-          rightPwr = 0;  // stop
-          leftDir = CCW;   // Forward  
-          rightDir = CW;   // Backward  
-        }
-        else {  // value < 0
-          leftPwr = 0;  // stop
-          rightPwr = scaledPower(abs(value));  
-          leftDir = CW;    // Backward  
-          rightDir = CCW;  // Forward  
-        }
-        
-        break;  
+  while (client && client.available() > 0) {  
+    if (client.peek() == PROTO_MAGIC) {  
+      if (client.available() < FRAME_LEN) break;  // Rest of the frame is still on its way  
+      client.read(buf, FRAME_LEN);  
+      uint32_t receivedMicros = micros();  
+      if (buf[1] != PROTO_VERSION || xorChecksum(buf, FRAME_LEN - 1) != buf[FRAME_LEN - 1]) {  
+        continue;  // Corrupt or unknown version: ignore  
+      }  
+      framedClient = true;  
+      lastFrameMs = millis();  
+      if (buf[3] & FLAG_ACK) {  
+        sendAck(buf, receivedMicros);  
+      }  
+      // Heartbeats carry the host's current command: after a watchdog stop (e.g. a WiFi stall)  
+      // it is applied again, since the host does not resend a command that did not change  
+      if (buf[2] == MSG_COMMAND || (buf[2] == MSG_HEARTBEAT && watchdogStopped)) {  
+        cmd = (int8_t)buf[10];  
+        value = (int16_t)((buf[11] << 8) | buf[12]);  
+        hasThrottle = buf[3] & FLAG_THROTTLE;  
+        throttle = (int16_t)((buf[13] << 8) | buf[14]);  
+        haveCmd = true;  
+      }  
+    } else {  
+      // Legacy 3-byte packet  
+      if (client.available() < LEGACY_LEN) break;  
+      client.read(buf, LEGACY_LEN);  
+      cmd = buf[0];  
+      value = (buf[1] << 8) | buf[2];  
+      hasThrottle = false;  
+      haveCmd = true;  
     }  
+  }  
+  
+  if (haveCmd) {  
+    applyCommand(cmd, value, hasThrottle, throttle);  
+    watchdogStopped = false;  
+  }  
   
-    robot.rotate(1, leftPwr, leftDir);  
-    robot.rotate(2, rightPwr, rightDir);  
+  // Watchdog: the host sends heartbeats while idle, silence means it is gone or stuck  
+  if (framedClient && millis() - lastFrameMs > WATCHDOG_MS) {  
+    applyCommand(CMD_STOP, 0, false, 0);  
+    framedClient = false;  
+    watchdogStopped = true;  
   }  
   
-  delay(10);  // Slight delay for stability  
+  delay(1);  // Let the Wi-Fi stack run; was 10 ms, which delayed every command  
 }
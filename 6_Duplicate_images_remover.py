@@ -1,27 +1,21 @@
 import os
-import shutil
+
+from selfdriving.dedup import dedup
 
 # Source folder
 source_folder = r"C:\VS Code Codes\Self Driving Car\tryout_backward_1"
-# Destination folder for unique images
+# Destination folder for unique images (hard links, no extra disk space)
 destination_folder = os.path.join(source_folder, "unique_images")
+# CSV list of the kept images and how many recorded frames each one stands for
+manifest_path = os.path.join(source_folder, "unique_images.csv")
 
-# Create destination folder if it doesn't exist
-os.makedirs(destination_folder, exist_ok=True)
-
-# Set to track unique image numbers
-unique_numbers = set()
-
-# Process files in the source folder
-for filename in os.listdir(source_folder):
-    if filename.lower().endswith(".jpg"):
-        # Extract the first part before the first underscore
-        image_number = filename.split('_')[0]
+# Frames whose perceptual hashes differ in at most HAMMING_RADIUS of 64 bits and that were
+# recorded within TIME_WINDOW seconds of each other count as duplicates; only the first is kept.
+HAMMING_RADIUS = 4
+TIME_WINDOW = 2.0
 
-        if image_number not in unique_numbers:
-            unique_numbers.add(image_number)
-            source_path = os.path.join(source_folder, filename)
-            dest_path = os.path.join(destination_folder, filename)
-            shutil.copy(source_path, dest_path)
+kept, total = dedup(source_folder, out=destination_folder, manifest=manifest_path,
+                    radius=HAMMING_RADIUS, window=TIME_WINDOW)
 
-print(f"Copied {len(unique_numbers)} unique images to: {destination_folder}")
+print(f"Kept {kept} of {total} images ({total - kept} near-duplicates) in: {destination_folder}")
+print(f"Manifest: {manifest_path}")
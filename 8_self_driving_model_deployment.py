@@ -1,211 +1,281 @@
-import tensorflow as tf  # Add at top
-gpus = tf.config.experimental.list_physical_devices('GPU')
-if gpus:
-    try:
-        for gpu in gpus:
-            tf.config.experimental.set_memory_growth(gpu, True)
-    except RuntimeError as e:
-        print(e)
+import time
+START = time.monotonic()  # For the time-to-first-command report
 
+import argparse
 import cv2
-import numpy as np
-import threading
-import time
-import struct
-import socket
-from datetime import datetime
-from keras.models import load_model
-from keras.optimizers import Adam
-from keras.losses import MeanSquaredError
-import requests
-from tensorflow.keras.models import load_model
-
-from tensorflow.python.client import device_lib
-print(device_lib.list_local_devices())
+
+# No TensorFlow here: the engine imports only the runtime its backend needs
+# (TensorFlow for keras, LiteRT/tflite_runtime for tflite, nothing for numpy)
+from selfdriving.car import CarClient, FrameSource
+from selfdriving.controllers import ModelController
+from selfdriving.inference import BACKENDS, load_engine
+from selfdriving.protocol import CMD_STOP
+from selfdriving.relay import MJPEGRelay
+from selfdriving.runtime import Job, LatestValue, Level, LoadShedder, Stage
+from selfdriving.serving import RemoteEngine
+from selfdriving.tracing import Every, Tracer
 
 # === CONFIG ===
-ESP32_IP = '192.168.4.1'
+ESP32_IP = '192.168.4.1'  # 127.0.0.1 with --stream-port 8081 for the replay simulator
 CMD_PORT = 8000
-STREAM_URL = f"http://{ESP32_IP}:81/stream"
-
-# Command codes
-CMD_STOP = 0
-CMD_FWD = 1
-CMD_TURN = 2
-
-# Shared resources
-frame_lock = threading.Lock()
-latest_frame = None
-original_frame = None
-stop_threads = False
-
-
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import InputLayer, Conv2D, Flatten, Dense
-
-def create_model():
-    model = Sequential([
-        InputLayer(input_shape=(66, 200, 3)),
-        Conv2D(24, (5,5), strides=(2,2), activation='relu'),
-        Conv2D(36, (5,5), strides=(2,2), activation='relu'),
-        Conv2D(48, (5,5), strides=(2,2), activation='relu'),
-        Conv2D(64, (3,3), activation='relu'),
-        Conv2D(64, (3,3), activation='relu'),
-        Flatten(),
-        Dense(100, activation='relu'),
-        Dense(50, activation='relu'),
-        Dense(10, activation='relu'),
-        Dense(1)
-    ])
-    return model
-
-# Create and load model
-model = create_model()
-model.load_weights(r"C:\VS Code Codes\Self Driving Car\new_non_golay_model_2.h5")
-model.compile(optimizer=Adam(learning_rate=1e-4), loss=MeanSquaredError())
-
-
-# TCP connection to ESP32 
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-print(f"Connecting to {ESP32_IP}:{CMD_PORT}…")
-sock.connect((ESP32_IP, CMD_PORT))
-print("Connected!")
-
-last_cmd = (0, 0)  # avoid repeated commands
-
-def send_cmd(code: int, value: int):
-    global last_cmd
-    if (code, value) == last_cmd:
-        return
-    last_cmd = (code, value)
-    packet = struct.pack(">bh", code, value)
-    sock.sendall(packet)
-
-def img_preprocess(img):
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)  # Color space convert
-    img = cv2.GaussianBlur(img, (3, 3), 0)      # Blur
-    img = cv2.resize(img, (200, 66))            # Resize for model input
-    img_display = img.copy()                    # Copy before normalization for display
-    img = img / 255.0                # Normalize for model
-
-    return img, img_display
-
-def fetch_stream():
-    global latest_frame, stop_threads, original_frame
+STREAM_PORT = 81
+
+MODEL_PATH = r"C:\VS Code Codes\Self Driving Car\new_non_golay_model_2.h5"
+BACKEND = 'auto'     # keras (traced tf.function), tflite or numpy; auto runs .tflite files
+                     # (e.g. the int8/float16 exports of selfdriving.quantize) with tflite
+DECODE_SCALE = 2     # Decode the 320x240 stream at 1/2 size, the model only needs 200x66
+SHOW_DISPLAY = True  # Camera and preprocessed windows; False (or --headless) runs without a GUI
+TRACE_FILE = 'latency_trace.json'  # Per-stage latency percentiles and raw timings, written on exit
+METRICS_PORT = None  # e.g. 9100 to serve the latencies on http://127.0.0.1:9100/metrics
+INFERENCE_SERVER = None  # e.g. '/tmp/selfdriving-inference.sock': share one model between cars
+                         # (python -m selfdriving.serving serve) instead of loading it here
+RELAY_PORT = None    # e.g. 8090 to share the camera: viewers and the recorder open
+                     # http://127.0.0.1:8090/stream instead of a second connection to the car
+STATUS_INTERVAL = 5  # Seconds between status lines (instead of printing every frame)
+MAX_COMMAND_AGE = 0.1  # Seconds from frame arrival to command; when the p95 gets close, shed load in steps:
+                       # no display, decode at 1/4, every 2nd frame, then FALLBACK_MODEL (if set)
+FALLBACK_MODEL = None  # e.g. an int8 .tflite export from selfdriving.quantize, loaded up front
+WARMUP_RUNS = 3      # Blank-frame inferences before the first command (tracing, allocation)
+MAX_INFERENCE_FAILURES = 3  # Failed predictions in a row (e.g. inference server gone) that stop the car
+
+COMMAND_ACKS = True       # Ask the car to ack every command, to measure the round trip
+LEGACY_PROTOCOL = False   # True for firmware that only understands the old 3-byte packets
+
+# Timestamps of every frame from arriving on the socket to its command being sent
+tracer = Tracer(['received', 'decoded', 'picked', 'preprocessed', 'predicted', 'sent'])
 
-    try:
-        resp = requests.get(STREAM_URL, stream=True, timeout=5)
-        if resp.status_code != 200:
-            print(f"[ERROR] Bad status: {resp.status_code}")
-            return
-    except Exception as e:
-        print("[ERROR] Could not connect to stream:", e)
-        return
-
-    buf = b''
-    for chunk in resp.iter_content(chunk_size=1024):
-        if stop_threads:
-            break
-        buf += chunk
-        s = buf.find(b'\xff\xd8')
-        e = buf.find(b'\xff\xd9')
-        if s != -1 and e != -1:
-            jpg = buf[s:e+2]
-            buf = buf[e+2:]
-            try:
-                img = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
-                if img is not None:
-                    flipped_img = cv2.flip(img, 0)
-                    with frame_lock:
-                        original_frame = flipped_img.copy()  # For prediction
-                        latest_frame = cv2.resize(flipped_img, (1100, 900))  # For display
-            except cv2.error:
-                continue
-    resp.close()
 
 def main():
-    cv2.namedWindow("Preprocessed View", cv2.WINDOW_NORMAL)
-    cv2.resizeWindow("Preprocessed View", 400, 150)
-
-    global latest_frame, stop_threads
-
-    # Start video stream thread
-    th = threading.Thread(target=fetch_stream, daemon=True)
-    th.start()
-
-    # Wait for first frame or timeout
-    start_time = time.time()
-    while latest_frame is None and time.time() - start_time < 5:
-        time.sleep(0.1)
-
-    if latest_frame is None:
-        print("[ERROR] No frames received within timeout.")
-        return
+    parser = argparse.ArgumentParser(description="Drive the car with the trained steering model.")
+    parser.add_argument('--model', default=MODEL_PATH, help="Keras .h5 weights or a .tflite model (float32, float16 or int8)")
+    parser.add_argument('--backend', default=BACKEND, choices=['auto', *BACKENDS],
+                        help="Inference backend, auto picks tflite for .tflite files")
+    parser.add_argument('--host', default=ESP32_IP, help="Car address (python -m selfdriving.simulator runs a local one)")
+    parser.add_argument('--stream-port', type=int, default=STREAM_PORT)
+    parser.add_argument('--cmd-port', type=int, default=CMD_PORT)
+    parser.add_argument('--trace', default=TRACE_FILE, help="JSON file for the latency trace, written on exit")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Serve Prometheus-style latency metrics on this local port")
+    parser.add_argument('--relay-port', type=int, default=RELAY_PORT,
+                        help="Re-serve the camera stream on this local port (see selfdriving.relay)")
+    parser.add_argument('--headless', action='store_true', help="No windows, same as SHOW_DISPLAY = False")
+    parser.add_argument('--legacy-protocol', action='store_true', default=LEGACY_PROTOCOL,
+                        help="Old 3-byte commands, for firmware without the framed protocol")
+    parser.add_argument('--warmup', type=int, default=WARMUP_RUNS, help="Warm-up inferences before driving")
+    parser.add_argument('--max-age', type=float, default=MAX_COMMAND_AGE,
+                        help="Command age bound in seconds for load shedding, 0 to turn it off")
+    parser.add_argument('--fallback-model', default=FALLBACK_MODEL, help="Cheaper model for the last shedding level")
+    parser.add_argument('--server', default=INFERENCE_SERVER,
+                        help="Predict on a shared inference server (Unix socket path or host:port), see selfdriving.serving")
+    args = parser.parse_args()
+    show_display = SHOW_DISPLAY and not args.headless
+
+    metrics = None
+    if args.metrics_port:
+        metrics = tracer.serve(args.metrics_port)
+        print(f"[OK] Latency metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    startup = {'imports': time.monotonic() - START}  # Seconds per startup step
+
+    # Command connection (framed protocol, selfdriving/protocol.py: sequence numbers, heartbeats that
+    # keep the car's watchdog from stopping it, optional acks) and camera stream, both reconnecting.
+    # The stream connects in the background while the model loads.
+    car = CarClient(args.host, args.cmd_port, args.stream_port, ack=COMMAND_ACKS, legacy=args.legacy_protocol)
+    relay = None
+    if args.relay_port:
+        # The autopilot subscribes in-process: no HTTP hop, and other clients never delay it
+        relay = MJPEGRelay(car.stream_url, port=args.relay_port).start()
+        camera = FrameSource(relay.subscribe(name='autopilot'), decode_scale=DECODE_SCALE).start()
+        print(f"[OK] Camera stream relayed on {relay.relay_url}")
     else:
-        print("[OK] Starting autonomous driving loop.")
-
-    cv2.namedWindow("ESP32-CAM", cv2.WINDOW_NORMAL)
-    cv2.resizeWindow("ESP32-CAM", 1100, 900)
+        camera = FrameSource(car.stream_url, decode_scale=DECODE_SCALE).start()
+
+    # Build the model from its weights (no compile, the optimizer is never used) with a fixed
+    # float32 input signature. Frames are flipped by the controller's preprocessor, on the small
+    # image where it is cheapest.
+    step = time.monotonic()
+    controller = ModelController(args.model, args.backend, flip=0)
+    if args.server:
+        controller.engine = RemoteEngine(args.server)  # The server has the model loaded already
+    controller.setup()
+    engine = controller.engine
+    startup['model'] = time.monotonic() - step
+    if args.server:
+        print(f"[OK] Connected to the inference server at {args.server}.")
+    else:
+        print(f"[OK] Loaded {args.model} ({engine.name} backend) in {startup['model']:.2f} s.")
+
+    # Pay for tracing and allocation now, not on the first frame while the car is moving
+    step = time.monotonic()
+    if args.warmup:
+        warmup = engine.warmup(args.warmup)
+        print(f"[OK] Warm-up: first inference {warmup[0] * 1000:.1f} ms, last {warmup[-1] * 1000:.1f} ms.")
+    startup['warmup'] = time.monotonic() - step
+
+    # Cheaper model for the last load shedding level, ready before it is needed
+    fallback = None
+    if args.fallback_model and args.max_age and not args.server:
+        fallback = load_engine(args.fallback_model)
+        fallback.warmup(args.warmup)
+        print(f"[OK] Fallback model {args.fallback_model} ({fallback.name} backend) ready.")
+
+    step = time.monotonic()
+    car.connect()
+    startup['connect'] = time.monotonic() - step
+
+    # Stages run on their own threads, each on the newest output of the one before:
+    # decode (camera thread) -> preprocess -> infer -> actuate, plus the display in this thread.
+    # A slow stage (or window) only lowers its own rate, steering always uses the newest prediction.
+    preprocessed = LatestValue()
+    predictions = LatestValue()
+    preview = LatestValue()
+    last_command = (0, 0)  # (steering value, command) for the status line
+    first_command = None   # Seconds from START to the first command sent
+    failures = 0           # Predictions that failed in a row
+
+    # What the load shedding levels switch; plain attributes, read by the stage threads
+    load = {'display': show_display, 'stride': 1, 'engine': engine}
+    levels = []
+    if show_display:
+        levels.append(Level('no display', lambda: load.update(display=False), lambda: load.update(display=True)))
+    if camera.decode_scale < 4:
+        scale = camera.decode_scale
+        levels.append(Level('decode at 1/4', lambda: setattr(camera, 'decode_scale', 4),
+                            lambda: setattr(camera, 'decode_scale', scale)))
+    levels.append(Level('every 2nd frame', lambda: load.update(stride=2), lambda: load.update(stride=1)))
+    if fallback is not None:
+        levels.append(Level('fallback model', lambda: load.update(engine=fallback), lambda: load.update(engine=engine)))
+    shedder = LoadShedder(levels, args.max_age) if args.max_age else None
+
+    def newest_frame(after, timeout):
+        # With a stride of N only every Nth camera frame is processed
+        frame = camera.get(after=after + load['stride'] - 1 if after else 0, timeout=timeout)
+        return None if frame is None else (frame.seq, frame)
+
+    def preprocess(frame):
+        picked = time.monotonic()
+        image_input = controller.preprocess(frame.image)
+        if load['display']:
+            preview.put((frame.image.copy(), controller.preprocess.small.copy()))
+        if args.server:
+            image_input = controller.preprocess.small  # 8-bit, a quarter of the bytes to send
+        # Copy: the preprocessor reuses its buffer for the next frame while this one is inferred
+        return Job(frame.seq, (frame.meta.received, frame.stamp, picked, time.monotonic()), image_input.copy())
+
+    def infer(job):
+        nonlocal failures
+        try:
+            steering_angle = load['engine'].predict(job.data)
+        except Exception:
+            failures += 1
+            if failures >= MAX_INFERENCE_FAILURES:
+                # Do not keep driving on the last command while blind
+                if failures == MAX_INFERENCE_FAILURES:
+                    print(f"[ERROR] {failures} predictions failed in a row, stopping the car")
+                car.send(CMD_STOP, 0)
+            raise
+        if failures >= MAX_INFERENCE_FAILURES:
+            print("[OK] Predictions are back, driving on")
+        failures = 0
+        return job.next(steering_angle)
+
+    def actuate(job):
+        nonlocal last_command, first_command
+        # Convert steering angle to a value in range [-100, 100]
+        steering_value = int(job.data * 100)
+
+        # Apply threshold logic: -16, 0 or 16 (shared with selfdriving.evaluate)
+        code, command = controller.decide(job.data)
+        car.send(code, command)  # Skips repeated commands
+        sent = time.monotonic()
+        tracer.record(job.seq, *job.stamps, sent)
+        if shedder is not None:
+            shedder.observe(sent - job.stamps[0])  # Age of the frame this command was computed from
+        last_command = (steering_value, command)
+        if first_command is None:
+            first_command = time.monotonic() - START
+            steps = ", ".join(f"{name} {seconds * 1000:.0f}" for name, seconds in startup.items())
+            print(f"[OK] First command {first_command:.2f} s after start ({steps} ms)")
+
+    stages = [
+        Stage('preprocess', newest_frame, preprocess, preprocessed.put),
+        Stage('infer', preprocessed.get, infer, predictions.put),
+        Stage('actuate', predictions.get, actuate),
+    ]
+
+    status_due = Every(STATUS_INTERVAL)
+    last_preview = 0
 
     try:
-        while True:
-            with frame_lock:
-                frame = latest_frame.copy() if latest_frame is not None else None
-                original = original_frame.copy() if original_frame is not None else None
-
-            if frame is not None and original is not None:
-                cv2.imshow("ESP32-CAM", frame)
-
-                # Preprocess image for model
-                processed, display_img = img_preprocess(original)
-
-                image_input = np.array([processed])
-
-                # Show preprocessed view
-                cv2.imshow("Preprocessed View", display_img)
-
-            image_input = np.array([processed])
-
-            # # Predict steering angle
-            prediction = model.predict(image_input, verbose=0)
-            steering_angle = float(prediction[0])
-            print(f"[DEBUG] Model prediction: {steering_angle:.4f}")
-
-            # steering_angle = -steering_angle
-
-            # Define threshold
-            threshold = 16
-
-            # Convert steering angle to a value in range [-100, 100]
-            steering_value = int(steering_angle * 100)
-
-            # Apply threshold logic
-            if steering_value <= -threshold:
-                send_cmd(CMD_TURN, -threshold)
-                print(f"[AUTO] Steering {steering_value} → sent {-threshold}")
-            elif -threshold < steering_value < threshold:
-                send_cmd(CMD_TURN, 0)
-                print(f"[AUTO] Steering {steering_value} → sent 0")
-            else:  # steering_value >= threshold
-                send_cmd(CMD_TURN, threshold)
-                print(f"[AUTO] Steering {steering_value} → sent {threshold}")
+        # Wait for first frame or timeout; returning from here still runs the cleanup below
+        step = time.monotonic()
+        if camera.get(timeout=5) is None:
+            print("[ERROR] No frames received within timeout.")
+            return
+        else:
+            print("[OK] Starting autonomous driving loop.")
+        startup['first frame'] = time.monotonic() - step
 
+        if show_display:
+            cv2.namedWindow("Preprocessed View", cv2.WINDOW_NORMAL)
+            cv2.resizeWindow("Preprocessed View", 400, 150)
+            cv2.namedWindow("ESP32-CAM", cv2.WINDOW_NORMAL)
+            cv2.resizeWindow("ESP32-CAM", 1100, 900)
 
-            # Quit on 'q' key
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+        for stage in stages:
+            stage.start()
 
-            # time.sleep(0.02)
+        while True:
+            if show_display:
+                # Display is only built when it is shown, and never holds up steering
+                got = preview.get(after=last_preview, timeout=0.05)
+                if got is not None:
+                    last_preview, (image, small) = got
+                    cv2.imshow("ESP32-CAM", cv2.resize(cv2.flip(image, 0), (1100, 900)))
+                    cv2.imshow("Preprocessed View", small)
+
+                # Quit on 'q' key
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            else:
+                time.sleep(0.05)
+
+            if shedder is not None:
+                shedder.update()
+
+            if status_due():
+                steering_value, command = last_command
+                shed = f" | load level {shedder.level} ({shedder.name})" if shedder is not None and shedder.level else ""
+                print(f"[AUTO] Steering {steering_value} → sent {command} | {tracer.summary()}{shed}")
 
     except KeyboardInterrupt:
         print("Exiting...")
 
     finally:
-        stop_threads = True
-        th.join(timeout=1)
-        cv2.destroyAllWindows()
-        sock.close()
+        for stage in stages:
+            stage.stop()
+        camera.close()
+        if relay is not None:
+            relay.stop()
+        if show_display:
+            cv2.destroyAllWindows()
+        car.close()  # Sends STOP
+        if metrics is not None:
+            metrics.shutdown()
+            metrics.server_close()
+        print("[INFO] Commands:", car.stats())
+        print("[INFO] Frames:", camera.stats())
+        if relay is not None:
+            print("[INFO] Relay:", relay.stats())
+        for stage in stages:
+            print(f"[INFO] {stage.name} stage:", stage.stats())
+        print("[INFO] Inference latency:", engine.latency.summary())
+        if shedder is not None:
+            print("[INFO] Load shedding:", shedder.stats())
+        print("[INFO] Frame to command:", tracer.summary())
+        if args.trace:
+            tracer.save(args.trace)
+            print(f"[OK] Latency trace saved to {args.trace}")
 
 if __name__ == "__main__":
     main()
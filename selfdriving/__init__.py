@@ -0,0 +1,6 @@
+"""Shared host-side code for the ESP32-CAM self-driving car.
+
+The numbered scripts in the repository root are the course steps; the
+modules in this package hold the pieces those scripts have in common so
+they can be reused, tested and benchmarked on their own.
+"""
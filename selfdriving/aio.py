@@ -0,0 +1,403 @@
+"""asyncio versions of the car connections, so one event loop can run the whole host side.
+
+Stream reading, commands, heartbeats, ack reading, joystick polling and
+status output are coroutines on one thread instead of threads blocking
+in ``requests``, ``sendall`` and ``time.sleep``. The only other thread
+is an executor for the CPU-heavy part (decode, preprocess, inference),
+which releases the GIL inside OpenCV and the model runtime:
+
+    python -m selfdriving.aio --model new_non_golay_model_2.h5 --backend numpy \
+        --host 127.0.0.1 --stream-port 8081          # against python -m selfdriving.simulator
+    python -m selfdriving.aio --joystick               # drive by hand
+
+The control loop runs on a deadline schedule (Ticker): tick n is due at
+start + n / hz, so the time spent in a tick and the sleep overshoot do
+not add up into drift the way ``time.sleep(0.02)`` does. Every network
+read and write has a timeout, and both connections reconnect with
+exponential backoff (car.Backoff).
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from selfdriving.car import CMD_PORT, ESP32_IP, STREAM_PORT, Backoff, StreamMeta
+from selfdriving.controllers import JoystickController, ModelController
+from selfdriving.frames import Frame
+from selfdriving.inference import BACKENDS, LatencyStats
+from selfdriving.mjpeg import MJPEGParser
+from selfdriving.preprocess import decode_jpeg
+from selfdriving.protocol import (ACK_SIZE, CMD_STOP, COMMAND, HEARTBEAT, HEARTBEAT_INTERVAL, LEGACY, WATCHDOG,
+                                  decode_ack, encode)
+from selfdriving.tracing import Every
+
+CONTROL_HZ = 50
+DECODE_SCALE = 2
+STATUS_INTERVAL = 5
+
+
+async def _body(reader, chunked, chunk_size, timeout):
+    """Raw body bytes of an HTTP response, undoing chunked transfer encoding (used by the ESP32)."""
+    while True:
+        if not chunked:
+            data = await asyncio.wait_for(reader.read(chunk_size), timeout)
+            if not data:
+                return
+            yield data
+            continue
+        size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b';')[0], 16)
+        if size == 0:
+            return
+        data = await asyncio.wait_for(reader.readexactly(size + 2), timeout)  # Chunk plus its CRLF
+        yield data[:-2]
+
+
+async def read_frames(host=ESP32_IP, port=STREAM_PORT, path='/stream', timeout=5, chunk_size=4096, backoff=None,
+                      verbose=True):
+    """Yield ``(received, jpeg)`` for the newest complete JPEG of every read from the MJPEG stream.
+
+    ``received`` is time.monotonic() when the data arrived. Reconnects with
+    ``backoff`` forever; stop by breaking out of the loop or cancelling.
+    """
+    backoff = backoff or Backoff()
+    while True:
+        await asyncio.sleep(backoff.remaining())
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            backoff.failed()
+            if verbose:
+                print(f"[ERROR] Could not connect to stream: {e!r}, retrying in {backoff.delay:g} s")
+            continue
+        try:
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            await asyncio.wait_for(writer.drain(), timeout)
+            status = await asyncio.wait_for(reader.readline(), timeout)
+            if status.split(b' ')[1:2] != [b'200']:
+                raise ConnectionError(f"Bad status: {status.decode(errors='replace').strip()}")
+            chunked = False
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'transfer-encoding' and 'chunked' in value.lower():
+                    chunked = True
+
+            parser = MJPEGParser()
+            async for data in _body(reader, chunked, chunk_size, timeout):
+                received = time.monotonic()
+                frames = parser.feed(data)
+                if frames:
+                    backoff.reset()
+                    yield received, bytes(frames[-1])  # Newest complete frame, older ones are stale
+            raise ConnectionError("Stream ended")
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if verbose:
+                print(f"[WARN] Stream interrupted: {e!r}")
+        finally:
+            writer.close()
+        backoff.failed()
+
+
+class AsyncCommandClient:
+    """Command connection to the car on the event loop: CarClient and CommandClient in one.
+
+    ``send`` skips a command identical to the previous one and drops
+    commands while disconnected; a background task sends heartbeats while
+    idle and reconnects with backoff. Like CommandClient, heartbeats stop
+    when ``send`` was not called for WATCHDOG seconds, so a stuck control
+    loop lets the firmware stop the car. With ``ack=True`` the round trip
+    times go to ``rtt``. ``legacy=True`` speaks the old 3-byte protocol.
+    """
+
+    def __init__(self, host=ESP32_IP, port=CMD_PORT, ack=False, legacy=False, heartbeat=HEARTBEAT_INTERVAL,
+                 timeout=2, backoff=None, verbose=True):
+        self.host = host
+        self.port = port
+        self.ack = ack and not legacy
+        self.legacy = legacy
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.verbose = verbose
+        self.backoff = backoff or Backoff()
+        self.rtt = LatencyStats()
+        self._writer = None
+        self._seq = 0
+        self._last = None
+        self._last_sent = 0.0
+        self._alive = 0.0  # Last send() call
+        self._sent_at = {}
+        self._tasks = []
+
+        # Counters
+        self.connects = 0
+        self.sent = 0
+        self.dropped = 0
+        self.heartbeats = 0
+        self.acks = 0
+        self.stalls = 0  # Times the heartbeats stopped because send() was not called
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        """Connect now if the backoff allows it and start the background task; returns whether connected."""
+        if not self._tasks:
+            self._tasks.append(asyncio.create_task(self._keepalive()))
+        if self._writer is None and self.backoff.ready():
+            try:
+                reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.backoff.failed()
+                if self.verbose:
+                    print(f"[ERROR] Could not connect to {self.host}:{self.port} ({e!r}), "
+                          f"retrying in {self.backoff.delay:g} s")
+                return False
+            self.backoff.reset()
+            self.connects += 1
+            self._last = None  # The first command on a new connection always goes out
+            self._sent_at.clear()
+            if self.ack:
+                self._tasks.append(asyncio.create_task(self._read_acks(reader, self._writer)))
+            if self.verbose:
+                print(f"[OK] Connected to {self.host}:{self.port}")
+        return self._writer is not None
+
+    def _disconnect(self, error):
+        if self._writer is None:
+            return
+        if self.verbose:
+            print(f"[WARN] Command connection lost: {error!r}")
+        self._writer.close()
+        self._writer = None
+        self.backoff.failed()
+
+    async def _write(self, data):
+        writer = self._writer
+        writer.write(data)
+        try:
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if writer is self._writer:
+                self._disconnect(e)
+            return False
+        return True
+
+    async def _send_frame(self, msg_type, code=0, steering=0, throttle=None):
+        self._seq = (self._seq + 1) & 0xFFFF
+        self._last_sent = time.monotonic()
+        if self.ack:
+            if len(self._sent_at) > 1024:
+                self._sent_at.clear()  # ACKs are not coming back
+            self._sent_at[self._seq] = self._last_sent
+        return await self._write(encode(msg_type, self._seq, code, steering, throttle, self.ack))
+
+    async def send(self, code, value, throttle=None, force=False):
+        """Send a command unless it repeats the previous one; returns whether it went out."""
+        self._alive = time.monotonic()
+        value = max(-100, min(100, value))
+        if not force and (code, value, throttle) == self._last:
+            return False
+        if self._writer is None:
+            # Never wait for a connection in the control tick, _keepalive reconnects in the background
+            if not self._tasks:
+                self._tasks.append(asyncio.create_task(self._keepalive()))
+            self.dropped += 1
+            return False
+        self._last = (code, value, throttle)
+        if self.legacy:
+            self._last_sent = time.monotonic()
+            ok = await self._write(LEGACY.pack(code, value))
+        else:
+            ok = await self._send_frame(COMMAND, code, value, throttle)
+        if not ok:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    async def _keepalive(self):
+        interval = self.heartbeat or 0.5
+        stalled = False
+        while True:
+            await asyncio.sleep(interval / 2)
+            now = time.monotonic()
+            if now - self._alive > WATCHDOG:
+                # Hung control loop: let the watchdog stop the car and resend the next command
+                if not stalled:
+                    stalled = True
+                    self.stalls += 1
+                self._last = None
+            else:
+                stalled = False
+            if self._writer is None:
+                await self.connect()
+            elif (not self.legacy and self.heartbeat and not stalled
+                  and now - self._last_sent >= self.heartbeat):
+                if await self._send_frame(HEARTBEAT, *(self._last or (CMD_STOP, 0, None))):
+                    self.heartbeats += 1
+
+    async def _read_acks(self, reader, writer):
+        try:
+            while True:
+                ack = decode_ack(await reader.readexactly(ACK_SIZE))
+                if ack is None:
+                    continue
+                sent_at = self._sent_at.pop(ack[0], None)
+                if sent_at is not None:
+                    self.rtt.add(time.monotonic() - sent_at)
+                    self.acks += 1
+        except (OSError, asyncio.IncompleteReadError) as e:
+            if writer is self._writer:
+                self._disconnect(e)
+
+    async def close(self):
+        """Stop the car (if connected), close the connection and the background tasks."""
+        if self._writer is not None:
+            await self.send(CMD_STOP, 0, force=True)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def stats(self):
+        return {'connects': self.connects, 'sent': self.sent, 'dropped': self.dropped,
+                'heartbeats': self.heartbeats, 'acks': self.acks, 'stalls': self.stalls,
+                'rtt': self.rtt.summary() if self.ack else None}
+
+
+class Ticker:
+    """Deadline-based periodic schedule for a control loop.
+
+    Tick n is due at start + n / hz, so neither the time spent in a tick
+    nor sleep overshoot accumulates. Deadlines already missed by more than
+    a period are skipped and counted in ``late``; ``lag`` keeps how late
+    each tick actually started.
+    """
+
+    def __init__(self, hz):
+        self.period = 1 / hz
+        self.ticks = 0
+        self.late = 0
+        self.lag = LatencyStats()
+        self._next = None
+
+    async def wait(self):
+        now = time.monotonic()
+        if self._next is None:
+            self._next = now
+        else:
+            self._next += self.period
+            if now - self._next > self.period:
+                missed = int((now - self._next) / self.period)
+                self.late += missed
+                self._next += missed * self.period
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.lag.add(max(0.0, time.monotonic() - self._next))
+        self.ticks += 1
+
+    def summary(self):
+        return f"{self.ticks} ticks, {self.late} missed, start lag {self.lag.summary()}"
+
+
+async def drive(controller, car, host=ESP32_IP, stream_port=STREAM_PORT, hz=CONTROL_HZ, decode_scale=DECODE_SCALE,
+                status_interval=STATUS_INTERVAL):
+    """Run ``controller`` at ``hz`` on the newest camera frame and send its commands with ``car``.
+
+    ModelController steps (decode, preprocess, predict) run in a
+    single-thread executor, so the loop keeps reading the stream and
+    feeding the watchdog meanwhile; other controllers run on the loop.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+    needs_frames = isinstance(controller, ModelController)
+    newest = None  # (seq, received, jpeg)
+    frames = 0
+
+    async def stream():
+        nonlocal newest, frames
+        async for received, jpeg in read_frames(host, stream_port):
+            frames += 1
+            newest = (frames, received, jpeg)
+
+    def infer(seq, received, jpeg):
+        image = decode_jpeg(jpeg, decode_scale)
+        if image is None:
+            return None
+        return controller(Frame(seq, image, time.monotonic(), StreamMeta(received, None)))
+
+    tasks = [asyncio.create_task(stream())] if needs_frames else []
+    await car.connect()
+    ticker = Ticker(hz)
+    status_due = Every(status_interval)
+    handled = 0
+    latency = LatencyStats()  # Frame arrival to command sent
+    try:
+        while True:
+            await ticker.wait()
+            if needs_frames:
+                if newest is None or newest[0] == handled:
+                    continue
+                seq, received, jpeg = newest
+                handled = seq
+                command = await loop.run_in_executor(executor, infer, seq, received, jpeg)
+                if command is None:
+                    continue
+                await car.send(*command)
+                latency.add(time.monotonic() - received)
+            else:
+                await car.send(*controller())
+
+            if status_due():
+                print(f"[AUTO] {ticker.summary()} | {frames} frames, frame to command {latency.summary()} "
+                      f"| commands {car.stats()}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await car.close()
+        executor.shutdown(wait=False)
+        print("[INFO] Control loop:", ticker.summary())
+        print("[INFO] Commands:", car.stats())
+        if needs_frames:
+            print(f"[INFO] {frames} frames, frame to command {latency.summary()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the car from one asyncio event loop.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--model', help="Keras .h5 weights or a .tflite model")
+    source.add_argument('--joystick', action='store_true', help="Drive with the PS4 controller instead")
+    parser.add_argument('--backend', default='auto', choices=['auto', *BACKENDS])
+    parser.add_argument('--host', default=ESP32_IP)
+    parser.add_argument('--stream-port', type=int, default=STREAM_PORT)
+    parser.add_argument('--cmd-port', type=int, default=CMD_PORT)
+    parser.add_argument('--hz', type=float, default=CONTROL_HZ, help="Control loop rate")
+    parser.add_argument('--no-ack', action='store_true', help="Do not ask the car for acks")
+    parser.add_argument('--legacy-protocol', action='store_true', help="Old 3-byte commands")
+    args = parser.parse_args()
+
+    if args.joystick:
+        controller = JoystickController()
+    else:
+        controller = ModelController(args.model, args.backend, flip=0)
+        controller.setup()
+        controller.engine.warmup()
+        print(f"[OK] Loaded {args.model} ({controller.engine.name} backend).")
+    car = AsyncCommandClient(args.host, args.cmd_port, ack=not args.no_ack, legacy=args.legacy_protocol)
+    try:
+        asyncio.run(drive(controller, car, args.host, args.stream_port, args.hz))
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        controller.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Batch version of the notebook's training augmentations.
+
+Zoom, pan and horizontal flip of one image are all affine, so they are
+folded into a single 2x3 matrix per image. The matrices for the whole
+batch are drawn at once with NumPy, each image is then warped exactly
+once (or just copied when it drew no augmentation), and the steering
+labels of flipped images are negated in the same pass:
+
+    images, steerings = augment_batch(images, steerings, np.random.default_rng(0))
+
+The distributions match Step 4 of the notebook: each augmentation is
+applied with probability 0.5, zoom scales by 1.0-1.3 around the image
+center, pan shifts by up to 10% of the width / height, and empty borders
+are filled with black like the albumentations ``A.Affine`` the notebook
+used before.
+"""
+import cv2
+import numpy as np
+
+ZOOM = (1.0, 1.3)  # Scale range
+PAN = 0.1          # Max shift, fraction of width / height
+P_ZOOM = P_PAN = P_FLIP = 0.5
+
+
+def affine_matrices(n, width, height, rng, zoom=ZOOM, pan=PAN, p_zoom=P_ZOOM, p_pan=P_PAN, p_flip=P_FLIP):
+    """Draw ``n`` augmentations; returns (n, 2, 3) float32 matrices and the boolean flip mask."""
+    scale = np.where(rng.random(n) < p_zoom, rng.uniform(zoom[0], zoom[1], n), 1.0)
+    shift = np.where((rng.random(n) < p_pan)[:, None], rng.uniform(-pan, pan, (n, 2)), 0.0)
+    shift *= (width, height)
+    flip = rng.random(n) < p_flip
+
+    # Zoom around the center, then pan: dst = scale * (src - center) + center + shift
+    cx, cy = (width - 1) / 2, (height - 1) / 2
+    matrices = np.zeros((n, 2, 3))
+    matrices[:, 0, 0] = matrices[:, 1, 1] = scale
+    matrices[:, 0, 2] = cx - scale * cx + shift[:, 0]
+    matrices[:, 1, 2] = cy - scale * cy + shift[:, 1]
+    # Horizontal flip: x -> width - 1 - x
+    matrices[flip, 0] *= -1
+    matrices[flip, 0, 2] += width - 1
+    return matrices.astype(np.float32), flip
+
+
+def augment_batch(images, steerings, rng, out=None, **kwargs):
+    """Randomly zoom, pan and flip a (N, H, W, C) batch; returns (images, steerings).
+
+    ``images`` is left untouched; the result goes to ``out`` (a new array
+    by default). Keyword arguments override the ranges and probabilities
+    of ``affine_matrices``.
+    """
+    n, height, width = images.shape[:3]
+    matrices, flip = affine_matrices(n, width, height, rng, **kwargs)
+    if out is None:
+        out = np.empty_like(images)
+
+    identity = np.array([[1, 0, 0], [0, 1, 0]], np.float32)
+    for i in range(n):
+        if np.array_equal(matrices[i], identity):
+            out[i] = images[i]
+        else:
+            cv2.warpAffine(images[i], matrices[i], (width, height), dst=out[i],
+                           flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    steerings = np.where(flip, -np.asarray(steerings), steerings)
+    return out, steerings
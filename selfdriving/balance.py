@@ -0,0 +1,60 @@
+"""Steering-histogram balancing for training sets.
+
+Recorded drives are mostly straight driving, so the notebook evens out the
+steering histogram before training. Every sample is assigned to exactly
+one of ``num_bins`` equal-width bins (the bins of ``np.histogram``), then:
+
+    keep = balance(steerings, 25, 100, seed=42)                    # at most 100 per bin
+    keep = balance(steerings, 25, 100, mode='weighted', seed=42)   # 100 per bin on average
+
+``'cap'`` randomly drops samples from bins with more than
+``samples_per_bin``. ``'weighted'`` instead draws samples with replacement,
+with probability inversely proportional to the size of their bin, so rare
+steering angles are repeated rather than common ones thrown away.
+
+Both run in O(n log n) and are reproducible for a given ``seed``.
+"""
+import numpy as np
+
+
+def bin_indices(steerings, num_bins):
+    """Bin of every sample (0 .. num_bins - 1) and the bin edges, as ``np.histogram`` bins them."""
+    steerings = np.asarray(steerings)
+    edges = np.histogram_bin_edges(steerings, num_bins)
+    # Interior edges only: values on the last edge stay in the last bin, like np.histogram
+    return np.digitize(steerings, edges[1:-1]), edges
+
+
+def sample_weights(steerings, num_bins):
+    """Per-sample weight inversely proportional to the size of its bin; weights sum to 1."""
+    bins, _ = bin_indices(steerings, num_bins)
+    counts = np.bincount(bins, minlength=num_bins)
+    weights = 1.0 / counts[bins]
+    return weights / weights.sum()
+
+
+def balance(steerings, num_bins=25, samples_per_bin=100, mode='cap', seed=0):
+    """Indices of the samples to train on, sorted.
+
+    ``mode='cap'`` keeps at most ``samples_per_bin`` random samples per bin
+    (no repeats). ``mode='weighted'`` draws ``samples_per_bin`` samples per
+    non-empty bin on average, with replacement.
+    """
+    steerings = np.asarray(steerings)
+    rng = np.random.default_rng(seed)
+    bins, _ = bin_indices(steerings, num_bins)
+
+    if mode == 'cap':
+        # Shuffle, then stable-sort by bin: each bin's samples end up in random order
+        order = rng.permutation(len(bins))
+        order = order[np.argsort(bins[order], kind='stable')]
+        counts = np.bincount(bins, minlength=num_bins)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        rank = np.arange(len(order)) - starts[bins[order]]
+        return np.sort(order[rank < samples_per_bin])
+
+    if mode == 'weighted':
+        size = np.count_nonzero(np.bincount(bins, minlength=num_bins)) * samples_per_bin
+        return np.sort(rng.choice(len(bins), size, p=sample_weights(steerings, num_bins)))
+
+    raise ValueError(f"mode must be 'cap' or 'weighted', got {mode!r}")
@@ -0,0 +1,521 @@
+"""Micro-benchmarks of the hot paths, with JSON baselines to compare against.
+
+    python -m selfdriving.bench run --save bench-before.json
+    ... change something ...
+    python -m selfdriving.bench run --compare bench-before.json
+    python -m selfdriving.bench compare bench-before.json bench-after.json --threshold 10
+
+Every benchmark runs on synthetic road-like 320x240 JPEGs (or the frames
+of a recorded folder with ``--data``) and the shipped
+new_non_golay_model_2.h5; nothing needs the car, a joystick or the
+network. Each one is timed in repeats of at least ``--min-time`` seconds
+and the median time per item (frame, command, sample) is what gets
+compared; the best repeat is stored too. ``compare`` exits with status 1
+when any benchmark got slower by more than the threshold, so it can gate
+a change. Timings only compare on the same machine: the metadata of both
+files is printed when it differs.
+
+Benchmarks that need TensorFlow (the Keras backend) are skipped when it
+is not installed. ``--only`` takes name prefixes, e.g. ``--only predict``.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import format_filename, list_samples
+
+MODEL_PATH = 'new_non_golay_model_2.h5'
+NUM_FRAMES = 240       # Synthetic frames; dedup and render work on all of them
+MIN_TIME = 0.2         # Seconds per repeat
+REPEATS = 5
+THRESHOLD = 10.0       # Percent slower per item that counts as a regression
+BENCHMARKS = {}        # name -> (setup, unit), see ``benchmark``
+
+
+class Skipped(Exception):
+    """Raised by a benchmark's setup when it cannot run here (e.g. no TensorFlow)."""
+
+
+def benchmark(name, unit='frame'):
+    """Register ``setup(context) -> (fn, items)``; ``fn()`` processes ``items`` units per call."""
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+    return register
+
+
+def synthetic_frames(n=NUM_FRAMES, seed=0, width=320, height=240, quality=80):
+    """JPEG bytes of ``n`` camera-like frames and their steering values (-100..100).
+
+    A grey road with lane lines that curves with the steering, under a sky
+    gradient, plus sensor noise so the JPEGs are about as large as real
+    ones. The car stands still in every 8th frame (a repeat of the one
+    before it), which gives dedup something to find.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    horizon = height // 3
+    sky = np.zeros((height, width, 3), np.uint8)
+    sky[:horizon] = np.linspace((230, 190, 150), (200, 160, 120), horizon)[:, None].astype(np.uint8)
+    sky[horizon:] = (60, 110, 70)  # Grass
+    depth = np.clip((rows - horizon) / (height - horizon), 0, 1)  # 0 at the horizon, 1 at the bottom
+    cols = np.arange(width, dtype=np.float32)[None, :]
+
+    jpegs, steerings = [], []
+    image = None
+    steering = 0
+    for i in range(n):
+        if i % 8 == 7 and image is not None:
+            noisy = image
+        else:
+            steering = int(np.clip(100 * math.sin(i / 15) + rng.normal(0, 10), -100, 100))
+            center = width / 2 + steering * 0.8 * (1 - depth) ** 2
+            offset = np.abs(cols - center)
+            half = 20 + 130 * depth
+            image = sky.copy()
+            road = (offset < half) & (depth > 0)
+            image[road] = (90, 90, 90)
+            lines = road & (np.abs(offset - half * 0.9) < 1 + 3 * depth)
+            image[lines] = (240, 240, 240)
+            noisy = cv2.add(image, rng.integers(0, 12, image.shape, np.uint8))
+        ok, jpg = cv2.imencode('.jpg', noisy, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        jpegs.append(jpg.tobytes())
+        steerings.append(steering)
+    return jpegs, steerings
+
+
+def load_folder(folder, n=NUM_FRAMES):
+    """JPEG bytes and steering values of the first ``n`` frames of a recorded folder."""
+    samples = list_samples(folder)[:n]
+    if not samples:
+        raise SystemExit(f"[ERROR] No recorded frames in {folder}")
+    jpegs = []
+    for sample in samples:
+        with open(sample.path, 'rb') as f:
+            jpegs.append(f.read())
+    return jpegs, [s.steering for s in samples]
+
+
+class Context:
+    """Inputs shared by the benchmarks, created on first use and cleaned up by ``close``."""
+
+    def __init__(self, jpegs, steerings, model_path=MODEL_PATH):
+        self.jpegs = jpegs
+        self.steerings = steerings
+        self.model_path = model_path
+        self.tmp = tempfile.mkdtemp(prefix='selfdriving-bench-')
+        self._cache = {}
+        self._cleanup = []
+
+    def once(self, key, make):
+        if key not in self._cache:
+            self._cache[key] = make()
+        return self._cache[key]
+
+    def on_close(self, fn):
+        self._cleanup.append(fn)
+
+    @property
+    def images(self):
+        """Full size BGR frames."""
+        return self.once('images', lambda: [cv2.imdecode(np.frombuffer(j, np.uint8), cv2.IMREAD_COLOR)
+                                            for j in self.jpegs])
+
+    @property
+    def inputs(self):
+        """(N, 66, 200, 3) float32 model inputs."""
+        def make():
+            from selfdriving.preprocess import Preprocessor
+            preprocess = Preprocessor(flip=None)
+            return np.concatenate([preprocess(image) for image in self.images])
+        return self.once('inputs', make)
+
+    @property
+    def folder(self):
+        """The frames written as a recorded folder, with recorder filenames."""
+        def make():
+            folder = os.path.join(self.tmp, 'images')
+            os.makedirs(folder)
+            start = datetime(2024, 1, 1)
+            for i, (jpg, steering) in enumerate(zip(self.jpegs, self.steerings)):
+                # 20 fps, like the recorder loop
+                name = format_filename(i, steering, start + timedelta(milliseconds=50 * i))
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(jpg)
+            return folder
+        return self.once('folder', make)
+
+    def engine(self, backend):
+        def make():
+            from selfdriving.inference import load_engine
+            if backend == 'keras':
+                try:
+                    import tensorflow  # noqa: F401
+                except ImportError:
+                    raise Skipped("TensorFlow is not installed")
+            engine = load_engine(self.model_path, backend)
+            engine.warmup()
+            return engine
+        return self.once(('engine', backend), make)
+
+    def close(self):
+        for fn in self._cleanup:
+            fn()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+# ——— BENCHMARKS ———
+
+@benchmark('mjpeg_parse')
+def _mjpeg_parse(ctx):
+    from selfdriving.mjpeg import MJPEGParser
+    # Same part format as the firmware, in the 1024-byte chunks the scripts read
+    stream = b''.join(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n" % (len(j), j)
+                      for j in ctx.jpegs)
+    chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+
+    def run():
+        parser = MJPEGParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    return run, len(ctx.jpegs)
+
+
+@benchmark('imdecode')
+def _imdecode(ctx):
+    def run():
+        for jpg in ctx.jpegs:
+            cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+    return run, len(ctx.jpegs)
+
+
+@benchmark('decode_jpeg_half')
+def _decode_jpeg_half(ctx):
+    from selfdriving.preprocess import decode_jpeg
+
+    def run():
+        for jpg in ctx.jpegs:
+            decode_jpeg(jpg, 2)
+    return run, len(ctx.jpegs)
+
+
+@benchmark('preprocess_uint8')
+def _preprocess_uint8(ctx):
+    from selfdriving.preprocess import preprocess_uint8
+    images = ctx.images
+
+    def run():
+        for image in images:
+            preprocess_uint8(image)
+    return run, len(images)
+
+
+@benchmark('preprocessor')
+def _preprocessor(ctx):
+    from selfdriving.preprocess import Preprocessor
+    preprocess = Preprocessor(flip=0)  # As in the deployment script
+    images = ctx.images
+
+    def run():
+        for image in images:
+            preprocess(image)
+    return run, len(images)
+
+
+def _predict(backend, n=20):
+    def setup(ctx):
+        engine = ctx.engine(backend)
+        inputs = ctx.inputs[:n]
+
+        def run():
+            for i in range(len(inputs)):
+                engine.predict(inputs[i:i + 1])
+        return run, len(inputs)
+    return setup
+
+
+def _predict_batch(backend, batch_size=64):
+    def setup(ctx):
+        engine = ctx.engine(backend)
+        inputs = ctx.inputs[:batch_size]
+        return (lambda: engine.predict_batch(inputs)), len(inputs)
+    return setup
+
+
+benchmark('predict_numpy')(_predict('numpy'))
+benchmark('predict_keras')(_predict('keras'))
+benchmark('predict_batch_numpy')(_predict_batch('numpy'))
+benchmark('predict_batch_keras')(_predict_batch('keras'))
+
+
+@benchmark('command_encode', unit='command')
+def _command_encode(ctx):
+    from selfdriving.protocol import COMMAND, encode
+    n = 1000
+
+    def run():
+        for seq in range(n):
+            encode(COMMAND, seq, 1, seq % 201 - 100)
+    return run, n
+
+
+@benchmark('command_send', unit='command')
+def _command_send(ctx):
+    from selfdriving.protocol import CMD_TURN, CommandClient
+
+    # Local TCP server that reads and discards everything, standing in for the firmware
+    server = socket.create_server(('127.0.0.1', 0))
+
+    def drain():
+        conn, _ = server.accept()
+        with conn:
+            while conn.recv(65536):
+                pass
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    client = CommandClient('127.0.0.1', server.getsockname()[1], heartbeat=0)
+
+    def close():
+        client.close()
+        thread.join(1)
+        server.close()
+    ctx.on_close(close)
+
+    n = 1000
+
+    def run():
+        for i in range(n):
+            client.send(CMD_TURN, i % 201 - 100, force=True)
+    return run, n
+
+
+@benchmark('batch_pipeline', unit='sample')
+def _batch_pipeline(ctx):
+    from selfdriving.augment import augment_batch
+    from selfdriving.cache import TensorCache
+    from selfdriving.pipeline import BatchPipeline, from_cache
+
+    cache = TensorCache(os.path.join(ctx.tmp, 'cache'))
+    rows = cache.build_jpegs(ctx.jpegs)
+    steerings = np.asarray(ctx.steerings, np.float32) / 100
+    batch_size = min(64, len(rows))  # A short --data folder still makes one batch
+    pipeline = BatchPipeline(from_cache(cache, rows), steerings, batch_size, augment=augment_batch, verbose=False)
+    ctx.on_close(pipeline.close)
+
+    def run():
+        for _ in pipeline.iterate(epochs=1):
+            pass
+    return run, len(pipeline) * pipeline.batch_size
+
+
+@benchmark('dedup')
+def _dedup(ctx):
+    from selfdriving.dedup import dedup
+    folder = ctx.folder
+    return (lambda: dedup(folder)), len(ctx.jpegs)
+
+
+def _render(backend):
+    def setup(ctx):
+        from selfdriving.render import render
+        paths = [s.path for s in list_samples(ctx.folder)]
+        engine = ctx.engine(backend) if backend else None
+        output = os.path.join(ctx.tmp, 'review.avi')
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):  # render prints its own [OK] line
+                render(paths, output, engine)
+        return run, len(paths)
+    return setup
+
+
+benchmark('render')(_render(None))
+benchmark('render_numpy')(_render('numpy'))
+
+
+# ——— TIMING ———
+
+def measure(fn, items, min_time=MIN_TIME, repeats=REPEATS):
+    """Time ``fn`` in ``repeats`` runs of at least ``min_time`` seconds each.
+
+    Returns the median and best microseconds per item, items per second
+    (from the median) and how many calls each repeat made.
+    """
+    fn()  # Warm up caches, thread pools and lazy imports
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.1))
+    times = [elapsed]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append(time.perf_counter() - start)
+    per_item = np.array(times) / (number * items) * 1e6
+    median = float(np.median(per_item))
+    return {
+        'us_per_item': round(median, 3),
+        'best_us_per_item': round(float(per_item.min()), 3),
+        'per_second': round(1e6 / median, 1),
+        'calls': number,
+        'repeats': repeats,
+    }
+
+
+def metadata():
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+def run(names=None, data=None, model_path=MODEL_PATH, min_time=MIN_TIME, repeats=REPEATS, verbose=True):
+    """Run the benchmarks starting with any of ``names`` (all by default); returns the report dict."""
+    selected = [n for n in BENCHMARKS if not names or any(n.startswith(prefix) for prefix in names)]
+    if not selected:
+        raise ValueError(f"No benchmark matches {names}, choose from {', '.join(BENCHMARKS)}")
+    jpegs, steerings = load_folder(data) if data else synthetic_frames()
+    report = {'meta': {**metadata(), 'data': data or 'synthetic', 'frames': len(jpegs), 'model': model_path},
+              'results': {}}
+    ctx = Context(jpegs, steerings, model_path)
+    try:
+        for name in selected:
+            setup, unit = BENCHMARKS[name]
+            try:
+                fn, items = setup(ctx)
+                result = {'unit': unit, 'items': items, **measure(fn, items, min_time, repeats)}
+            except Skipped as e:
+                if verbose:
+                    print(f"[INFO] {name:<20} skipped: {e}")
+                continue
+            report['results'][name] = result
+            if verbose:
+                print(f"[OK] {name:<20} {result['us_per_item']:>10.1f} us/{unit:<8} "
+                      f"{result['per_second']:>10.1f} {unit}s/s")
+    finally:
+        ctx.close()
+    return report
+
+
+# ——— BASELINES ———
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """Per-benchmark change of the median time per item, in percent (positive is slower).
+
+    Returns ``[(name, old_us, new_us, change, status)]`` with status
+    'regression', 'improvement' or 'ok' depending on whether the change
+    is beyond ``threshold`` percent, or 'new' / 'missing' for benchmarks
+    in only one of the reports.
+    """
+    old, new = baseline['results'], current['results']
+    rows = []
+    for name in list(old) + [n for n in new if n not in old]:
+        if name not in new:
+            rows.append((name, old[name]['us_per_item'], None, None, 'missing'))
+            continue
+        if name not in old:
+            rows.append((name, None, new[name]['us_per_item'], None, 'new'))
+            continue
+        old_us, new_us = old[name]['us_per_item'], new[name]['us_per_item']
+        change = (new_us / old_us - 1) * 100
+        status = 'regression' if change > threshold else 'improvement' if change < -threshold else 'ok'
+        rows.append((name, old_us, new_us, change, status))
+    return rows
+
+
+def print_comparison(baseline, current, threshold=THRESHOLD):
+    """Print the comparison table; returns the number of regressions."""
+    keys = ('platform', 'cpus', 'python', 'numpy', 'opencv', 'data', 'frames', 'model')
+    different = [k for k in keys if baseline['meta'].get(k) != current['meta'].get(k)]
+    if different:
+        print("[WARN] The reports come from different setups, timings may not compare:")
+        for key in different:
+            print(f"       {key}: {baseline['meta'].get(key)} -> {current['meta'].get(key)}")
+
+    def us(value):
+        return '-' if value is None else f"{value:.1f}"
+
+    print(f"{'benchmark':<20} {'old us':>10} {'new us':>10} {'change':>8}")
+    regressions = 0
+    for name, old_us, new_us, change, status in compare(baseline, current, threshold):
+        change_text = '' if change is None else f"{change:+.1f}%"
+        flag = '' if status == 'ok' else status.upper()
+        print(f"{name:<20} {us(old_us):>10} {us(new_us):>10} {change_text:>8}  {flag}".rstrip())
+        regressions += status == 'regression'
+    if regressions:
+        print(f"[ERROR] {regressions} benchmark(s) more than {threshold:g}% slower")
+    else:
+        print(f"[OK] No benchmark more than {threshold:g}% slower")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths and compare against a baseline.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('--only', nargs='+', metavar='PREFIX', help=f"Benchmarks to run: {', '.join(BENCHMARKS)}")
+    run_parser.add_argument('--data', help="Recorded folder to take frames from instead of synthetic ones")
+    run_parser.add_argument('--model', default=MODEL_PATH)
+    run_parser.add_argument('--min-time', type=float, default=MIN_TIME, help="Seconds per repeat")
+    run_parser.add_argument('--repeats', type=int, default=REPEATS)
+    run_parser.add_argument('--save', metavar='PATH', help="Write the results as a JSON baseline")
+    run_parser.add_argument('--compare', metavar='BASELINE', help="Compare the results against a saved baseline")
+    run_parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Percent slower that fails")
+
+    compare_parser = commands.add_parser('compare', help="Compare two saved results")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Percent slower that fails")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        raise SystemExit(1 if print_comparison(load(args.baseline), load(args.current), args.threshold) else 0)
+
+    baseline = load(args.compare) if args.compare else None  # Fail before running if it is missing
+    report = run(args.only, args.data, args.model, args.min_time, args.repeats)
+    if args.save:
+        save(report, args.save)
+        print(f"[OK] Saved {args.save}")
+    if baseline is not None:
+        if args.only:  # Benchmarks that were not selected are not missing
+            baseline['results'] = {k: v for k, v in baseline['results'].items() if k in report['results']}
+        raise SystemExit(1 if print_comparison(baseline, report, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Cache of preprocessed training images.
+
+Decoding a 320x240 JPEG and running the YUV/blur/resize preprocessing is
+most of the cost of a training step, and the result never changes for a
+given file. TensorCache keeps the 66x200 uint8 YUV tensors in one
+memory-mapped file, keyed by a hash of the source JPEG bytes:
+
+    cache = TensorCache("track_images_dataset/.tensor_cache")
+    rows = cache.build(image_paths)            # only new or changed files are decoded
+    images = cache.tensors[rows[:64]]          # (64, 66, 200, 3) uint8 YUV
+    batch = cache.batch(rows[:64])             # float32 / 255, ready for the model
+
+Files whose size and modification time did not change since the last
+build are not even re-read.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from selfdriving.preprocess import IMG_HEIGHT, IMG_WIDTH, preprocess_uint8
+
+TENSOR_SHAPE = (IMG_HEIGHT, IMG_WIDTH, 3)
+_ROW_BYTES = int(np.prod(TENSOR_SHAPE))
+_VERSION = 1
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _load_tensor(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return preprocess_uint8(image)
+
+
+class TensorCache:
+    """Append-only store of preprocessed (66, 200, 3) uint8 YUV images.
+
+    ``tensors`` is a read-only memmap of every cached row. Entries of files
+    that changed stay in the file unused; delete the cache folder to reclaim
+    the space.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._data_path = os.path.join(folder, 'tensors.u8')
+        self._index_path = os.path.join(folder, 'index.json')
+
+        self._rows = {}   # content hash -> row
+        self._files = {}  # path -> [size, mtime_ns, content hash]
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                index = json.load(f)
+            if index.get('version') == _VERSION and tuple(index['shape']) == TENSOR_SHAPE:
+                self._rows = index['rows']
+                self._files = index['files']
+
+        # Drop rows appended after the last saved index (interrupted build)
+        with open(self._data_path, 'ab') as f:
+            f.truncate(len(self._rows) * _ROW_BYTES)
+        self._map()
+
+        # Counters of the last build()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _map(self):
+        if self._rows:
+            self.tensors = np.memmap(self._data_path, np.uint8, mode='r', shape=(len(self._rows),) + TENSOR_SHAPE)
+        else:
+            self.tensors = np.zeros((0,) + TENSOR_SHAPE, np.uint8)
+
+    def _save_index(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': _VERSION, 'shape': TENSOR_SHAPE, 'rows': self._rows, 'files': self._files}, f)
+        os.replace(tmp, self._index_path)
+
+    def _key(self, path):
+        """Content hash of ``path`` and its bytes (None when the stat matches the last build)."""
+        stat = os.stat(path)
+        known = self._files.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns and known[2] in self._rows:
+            return known[2], None
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = content_hash(data)
+        self._files[path] = [stat.st_size, stat.st_mtime_ns, key]
+        self._dirty = True
+        return key, data
+
+    def _add(self, pending, rows, pool):
+        # Decode and preprocess a chunk of new images and append them to the data file
+        self._dirty = True
+        keys = list(pending)
+        with open(self._data_path, 'ab') as f:
+            # cv2 releases the GIL, so threads decode in parallel
+            for key, tensor in zip(keys, pool.map(lambda k: _load_tensor(pending[k][0]), keys)):
+                positions = pending[key][1]
+                if tensor is None:
+                    rows[positions] = -1
+                    continue
+                f.write(tensor.tobytes())
+                self._rows[key] = rows[positions] = len(self._rows)
+                self.misses += len(positions)
+        pending.clear()
+
+    def build(self, image_paths, workers=None, chunk_size=1024):
+        """Make sure every image is cached; returns the row of each path as an int array.
+
+        New or changed files are read, hashed and preprocessed ``chunk_size``
+        at a time on ``workers`` threads. Images that fail to decode get row -1.
+        """
+        return self._build((self._key(str(path)) for path in image_paths), len(image_paths), workers, chunk_size)
+
+    def build_jpegs(self, jpegs, workers=None, chunk_size=1024):
+        """Like ``build``, for JPEG bytes in memory (e.g. ``ShardDataset.jpeg(i)``); every one is hashed."""
+        return self._build(((content_hash(jpeg), jpeg) for jpeg in jpegs), len(jpegs), workers, chunk_size)
+
+    def _build(self, keys, count, workers, chunk_size):
+        # keys yields (content hash, bytes or None) per image
+        self.hits = self.misses = 0
+        self._dirty = False
+        rows = np.empty(count, np.int64)
+        pending = {}  # content hash -> (bytes, positions)
+        with ThreadPoolExecutor(workers) as pool:
+            for i, (key, data) in enumerate(keys):
+                if key in self._rows:
+                    rows[i] = self._rows[key]
+                    self.hits += 1
+                elif key in pending:
+                    pending[key][1].append(i)
+                else:
+                    pending[key] = (data, [i])
+                    if len(pending) >= chunk_size:
+                        self._add(pending, rows, pool)
+            if pending:
+                self._add(pending, rows, pool)
+
+        if self._dirty:
+            self._save_index()
+            self._map()
+        return rows
+
+    def batch(self, rows, out=None):
+        """Float32 model input for the given rows, scaled to [0, 1] like the training preprocess."""
+        images = self.tensors[rows]
+        if out is None:
+            out = np.empty(images.shape, np.float32)
+        np.multiply(images, np.float32(1 / 255.0), out=out)
+        return out
@@ -0,0 +1,356 @@
+"""Connections to the car: commands and camera stream, opened on first use.
+
+Nothing here touches the network at import or construction time, so the
+scripts (and benchmarks) can build a CarClient and a FrameSource up
+front and the connection only happens when the first command is sent or
+the first frame is requested:
+
+    car = CarClient('192.168.4.1', ack=True)
+    camera = FrameSource(car.stream_url, decode_scale=2)
+    frame = camera.get(timeout=5)    # Starts the stream thread
+    car.send(CMD_TURN, 16)           # Starts connecting the command socket
+    ...
+    camera.close()
+    car.close()
+
+Both reconnect on their own background threads when the car drops off
+the WiFi, backing off exponentially between attempts, so a car that is
+gone never stalls the control loop.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+
+from selfdriving.frames import FrameRing
+from selfdriving.mjpeg import MJPEGParser
+from selfdriving.preprocess import decode_jpeg
+from selfdriving.protocol import CommandClient
+
+ESP32_IP = '192.168.4.1'
+CMD_PORT = 8000
+STREAM_PORT = 81
+
+# meta of every Frame from a FrameSource. received: time.monotonic() when the
+# JPEG's last chunk arrived, jpeg: the raw bytes if keep_jpeg is set, else None.
+StreamMeta = namedtuple('StreamMeta', 'received jpeg')
+
+
+class Backoff:
+    """Exponential backoff between reconnect attempts: ``initial``, 2x, 4x, ... up to ``maximum`` seconds."""
+
+    def __init__(self, initial=0.5, maximum=5.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self._next = 0.0
+
+    def ready(self):
+        """Whether the next attempt is due."""
+        return time.monotonic() >= self._next
+
+    def remaining(self):
+        """Seconds until the next attempt is due."""
+        return max(0.0, self._next - time.monotonic())
+
+    def wait(self, stop):
+        """Sleep until the next attempt is due; returns False if ``stop`` (an Event) was set meanwhile."""
+        return not stop.wait(self.remaining())
+
+    def failed(self):
+        self.delay = min(self.maximum, self.delay * 2 if self.delay else self.initial)
+        self._next = time.monotonic() + self.delay
+
+    def reset(self):
+        self.delay = 0.0
+        self._next = 0.0
+
+
+def stream_frames(url, stop, backoff=None, chunk_size=1024, timeout=5, on_connect=None, verbose=True):
+    """Yield ``(received, jpeg)`` for the newest complete JPEG of every chunk of an MJPEG stream.
+
+    ``received`` is time.monotonic() when the chunk arrived and ``jpeg`` a
+    memoryview from MJPEGParser. The stream is reopened with ``backoff``
+    whenever it fails or ends, until ``stop`` (an Event) is set.
+    """
+    import requests  # Only needed once frames are requested
+
+    backoff = backoff or Backoff()
+    while backoff.wait(stop):
+        try:
+            resp = requests.get(url, stream=True, timeout=timeout)
+            if resp.status_code != 200:
+                raise ConnectionError(f"Bad status: {resp.status_code}")
+        except Exception as e:
+            backoff.failed()
+            if verbose:
+                print(f"[ERROR] Could not connect to stream: {e}, retrying in {backoff.delay:g} s")
+            continue
+        if on_connect is not None:
+            on_connect()
+        try:
+            parser = MJPEGParser()
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if stop.is_set():
+                    return
+                received = time.monotonic()
+                frames = parser.feed(chunk)
+                if frames:
+                    backoff.reset()
+                    yield received, frames[-1]  # Newest complete frame, older ones are stale
+        except Exception as e:
+            if verbose and not stop.is_set():
+                print(f"[WARN] Stream interrupted: {e}")
+        finally:
+            resp.close()
+        if not stop.is_set():
+            backoff.failed()
+
+
+class CarClient:
+    """Command connection to the car that connects on first use and reconnects after errors.
+
+    The connection (a ``selfdriving.protocol.CommandClient``) is kept open
+    and reused for every command. Connecting happens on a background
+    thread with backoff between attempts; until it succeeds ``send`` drops
+    commands without blocking. The first command on a new connection is
+    always sent, even if it repeats the last one from before. After
+    ``close`` no new connection is made.
+    """
+
+    def __init__(self, host=ESP32_IP, cmd_port=CMD_PORT, stream_port=STREAM_PORT, ack=False, legacy=False,
+                 timeout=2, backoff=None, verbose=True):
+        self.host = host
+        self.cmd_port = cmd_port
+        self.stream_port = stream_port
+        self.ack = ack
+        self.legacy = legacy
+        self.timeout = timeout
+        self.verbose = verbose
+        self.backoff = backoff or Backoff()
+        self._client = None
+        self._rtt = None  # Round trip times of the newest connection, kept after it closed
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # Notified after every connection attempt
+        self._connecting = None  # Background thread while a connection is being made
+        self._closed = threading.Event()
+
+        # Counters
+        self.attempts = 0
+        self.connects = 0
+        self.dropped = 0  # Commands lost while disconnected
+        self._sent = self._heartbeats = self._acks = self._stalls = 0  # Of connections already closed
+
+    @property
+    def stream_url(self):
+        return f"http://{self.host}:{self.stream_port}/stream"
+
+    @property
+    def connected(self):
+        return self._client is not None and self._client.error is None
+
+    @property
+    def rtt(self):
+        """LatencyStats of the round trips on the newest connection (``ack=True`` only)."""
+        return self._rtt
+
+    def connect(self):
+        """Start connecting now instead of on the first command and wait for the attempt; returns whether it worked."""
+        with self._changed:
+            attempts = self.attempts
+            if self._ensure() is None:
+                self._changed.wait_for(lambda: self._client is not None or self.attempts > attempts,
+                                       self.backoff.remaining() + self.timeout + 1)
+            return self._client is not None
+
+    def _ensure(self):
+        # With _lock held: the connection if it is usable, else None with a reconnect under way
+        if self._client is not None and self._client.error is not None:
+            if self.verbose:
+                print(f"[WARN] Command connection lost: {self._client.error}")
+            self._drop()
+            self.backoff.failed()
+        if self._client is None and self._connecting is None and not self._closed.is_set():
+            self._connecting = threading.Thread(target=self._reconnect, name='car-connect', daemon=True)
+            self._connecting.start()
+        return self._client
+
+    def _reconnect(self):
+        while self.backoff.wait(self._closed):
+            try:
+                client = CommandClient(self.host, self.cmd_port, ack=self.ack, legacy=self.legacy,
+                                       timeout=self.timeout)
+            except OSError as e:
+                self.backoff.failed()
+                if self.verbose:
+                    print(f"[ERROR] Could not connect to {self.host}:{self.cmd_port} ({e}), "
+                          f"retrying in {self.backoff.delay:g} s")
+                with self._changed:
+                    self.attempts += 1
+                    self._changed.notify_all()
+                continue
+            with self._changed:
+                self.attempts += 1
+                self._connecting = None
+                if self._closed.is_set():
+                    client.close()  # close() ran during the attempt
+                    return
+                self.backoff.reset()
+                self._client = client
+                self._rtt = client.rtt
+                self.connects += 1
+                self._changed.notify_all()
+            if self.verbose:
+                print(f"[OK] Connected to {self.host}:{self.cmd_port}")
+            return
+        with self._lock:
+            self._connecting = None
+
+    def _drop(self):
+        client, self._client = self._client, None
+        self._sent += client.sent
+        self._heartbeats += client.heartbeats
+        self._acks += client.acks
+        self._stalls += client.stalls
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+
+    def send(self, code, value, throttle=None, force=False):
+        """Send a command unless it repeats the previous one; returns whether it went out."""
+        with self._lock:
+            client = self._ensure()
+            if client is None:
+                self.dropped += 1
+                return False
+            try:
+                return client.send(code, value, throttle, force)
+            except OSError as e:
+                client.error = e
+                self.dropped += 1
+                return False
+
+    def close(self):
+        """Stop the car (if connected) and close the connection."""
+        self._closed.set()
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._drop()
+
+    def stats(self):
+        client = self._client
+        return {
+            'connects': self.connects,
+            'sent': self._sent + (client.sent if client else 0),
+            'dropped': self.dropped,
+            'heartbeats': self._heartbeats + (client.heartbeats if client else 0),
+            'acks': self._acks + (client.acks if client else 0),
+            'stalls': self._stalls + (client.stalls if client else 0),
+            'rtt': self._rtt.summary() if self._rtt is not None and self.ack else None,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameSource:
+    """Camera frames from the car's MJPEG stream, decoded on a background thread.
+
+    The thread starts on the first ``get`` (or ``start``) and decodes only
+    the newest complete JPEG of every chunk into a FrameRing, so ``get``
+    always returns the newest frame. ``url`` is the stream URL, or a
+    ``selfdriving.relay.Subscription`` to take frames from a relay in the
+    same process. ``flip`` is a cv2.flip code applied
+    while copying into the ring (None keeps the camera orientation),
+    ``decode_scale`` decodes at 1/2, 1/4 or 1/8 size and ``keep_jpeg``
+    keeps the raw JPEG bytes in ``frame.meta.jpeg``. A dropped stream is
+    reopened with backoff.
+    """
+
+    def __init__(self, url, decode_scale=1, flip=None, keep_jpeg=False, chunk_size=1024, timeout=5,
+                 backoff=None, verbose=True):
+        self.url = url
+        self.decode_scale = decode_scale
+        self.flip = flip
+        self.keep_jpeg = keep_jpeg
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.verbose = verbose
+        self.backoff = backoff or Backoff()
+        self.ring = FrameRing()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.connects = 0
+        self.errors = 0  # Frames that failed to decode
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='frames', daemon=True)
+            self._thread.start()
+        return self
+
+    def get(self, after=0, timeout=None):
+        """Newest Frame with ``seq > after``, see ``FrameRing.get``; starts the stream if needed."""
+        if self._thread is None:
+            self.start()
+        return self.ring.get(after, timeout)
+
+    def _run(self):
+        if isinstance(self.url, str):
+            frames = stream_frames(self.url, self._stop, self.backoff, self.chunk_size, self.timeout,
+                                   self._connected, self.verbose)
+        else:
+            frames = self._subscribed()
+        for received, jpg in frames:
+            self._decode(received, jpg)
+        self.ring.close()
+
+    def _connected(self):
+        self.connects += 1
+
+    def _subscribed(self):
+        # In-process frames from a selfdriving.relay.Subscription, already cut from the stream
+        self.connects += 1
+        while not self._stop.is_set():
+            frame = self.url.get(timeout=0.1)
+            if frame is not None:
+                yield frame.received, frame.jpeg
+
+    def _decode(self, received, jpg):
+        try:
+            img = decode_jpeg(jpg, self.decode_scale)
+        except cv2.error:
+            img = None
+        if img is None:
+            self.errors += 1
+            return
+        meta = StreamMeta(received, bytes(jpg) if self.keep_jpeg else None)
+        if self.flip is None:
+            self.ring.put(img, meta)
+        else:
+            # Flip straight into the ring's buffer
+            cv2.flip(img, self.flip, dst=self.ring.acquire(img.shape))
+            self.ring.publish(meta)
+
+    def close(self, timeout=1):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.ring.close()
+
+    def stats(self):
+        return {**self.ring.stats(), 'connects': self.connects, 'errors': self.errors}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
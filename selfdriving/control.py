@@ -0,0 +1,13 @@
+import numpy as np
+
+TURN_THRESHOLD = 16  # Steering (-100..100) at which the car is told to turn
+
+
+def steering_command(steering_value, threshold=TURN_THRESHOLD):
+    """The turn command the deployment script sends for a -100..100 steering value.
+
+    -threshold, 0 or threshold; works on single values and NumPy arrays.
+    """
+    command = np.where(steering_value <= -threshold, -threshold,
+                       np.where(steering_value >= threshold, threshold, 0))
+    return int(command) if command.ndim == 0 else command
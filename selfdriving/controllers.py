@@ -0,0 +1,164 @@
+"""Where the driving commands come from: a joystick, the steering model or a recorded drive.
+
+Every controller turns the current camera frame into a ``(code, value)``
+command for ``CarClient.send`` and sets itself up (pygame, the model) on
+its first call, so scripts can construct one without paying for it until
+the loop starts:
+
+    controller = ModelController('new_non_golay_model_2.h5')
+    while True:
+        frame = camera.get(after=frame.seq)
+        car.send(*controller(frame))
+
+``close()`` releases whatever was set up.
+"""
+import numpy as np
+
+from selfdriving.control import TURN_THRESHOLD, steering_command
+from selfdriving.dataset import list_samples
+from selfdriving.inference import load_engine
+from selfdriving.preprocess import Preprocessor
+from selfdriving.protocol import CMD_FWD, CMD_STOP, CMD_TURN
+
+
+class Controller:
+    """Base class: ``command(frame)`` returns ``(code, value)``, ``setup()`` runs once before the first one."""
+
+    _ready = False
+
+    def setup(self):
+        pass
+
+    def command(self, frame):
+        raise NotImplementedError
+
+    def start(self):
+        """Run ``setup`` now instead of before the first command, e.g. to fail early; returns self."""
+        if not self._ready:
+            self.setup()
+            self._ready = True
+        return self
+
+    def __call__(self, frame=None):
+        self.start()
+        return self.command(frame)
+
+    def close(self):
+        pass
+
+
+class JoystickController(Controller):
+    """PS4 controller: hold R2 (dead man's switch) and steer with the right stick.
+
+    With ``forward=True`` the stick's dominant direction picks between
+    CMD_FWD (vertical) and CMD_TURN (horizontal), as in the recording
+    script; otherwise only the horizontal axis is used, for CMD_TURN.
+    The magnitude is the stick deflection, -100..100. Releasing R2 sends
+    CMD_STOP. ``deadman_threshold`` is compared with the raw R2 axis,
+    which goes from -1 (released) to 1 (fully pressed).
+    """
+
+    def __init__(self, index=0, steer_axis=2, throttle_axis=3, deadman_axis=5, deadman_threshold=0.5,
+                 invert=True, forward=True):
+        self.index = index
+        self.steer_axis = steer_axis
+        self.throttle_axis = throttle_axis
+        self.deadman_axis = deadman_axis
+        self.deadman_threshold = deadman_threshold
+        self.invert = invert
+        self.forward = forward
+        self.joystick = None
+
+    def setup(self):
+        import pygame  # Only needed when a joystick is actually used
+
+        self._pygame = pygame
+        pygame.init()
+        pygame.joystick.init()
+        if pygame.joystick.get_count() <= self.index:
+            raise RuntimeError("No joystick detected!")
+        self.joystick = pygame.joystick.Joystick(self.index)
+        self.joystick.init()
+        print("Using joystick:", self.joystick.get_name())
+
+    def command(self, frame=None):
+        self._pygame.event.pump()
+        sign = -1 if self.invert else 1
+        x = sign * self.joystick.get_axis(self.steer_axis)
+        y = sign * self.joystick.get_axis(self.throttle_axis) if self.forward else 0.0
+
+        if self.joystick.get_axis(self.deadman_axis) <= self.deadman_threshold:
+            return CMD_STOP, 0
+        if abs(y) > abs(x):  # Forward/backward
+            return CMD_FWD, int(np.clip(y, -1, 1) * 100)
+        return CMD_TURN, int(np.clip(x, -1, 1) * 100)
+
+    def close(self):
+        if self.joystick is not None:
+            self._pygame.quit()
+            self.joystick = None
+
+
+class ModelController(Controller):
+    """The trained steering model: frame -> preprocess -> predict -> thresholded CMD_TURN.
+
+    The three steps are also available on their own (``preprocess``,
+    ``predict``, ``decide``) for loops that run them on separate threads.
+    The engine is loaded by ``setup()``, i.e. on the first call, unless
+    the script loads it earlier to keep that out of the driving loop.
+    """
+
+    def __init__(self, model_path, backend='auto', flip=0, threshold=TURN_THRESHOLD):
+        self.model_path = model_path
+        self.backend = backend
+        self.threshold = threshold
+        self.preprocess = Preprocessor(flip=flip)
+        self.engine = None
+
+    def setup(self):
+        if self.engine is None:
+            self.engine = load_engine(self.model_path, self.backend)
+
+    def predict(self, image_input):
+        """Normalized steering angle for a preprocessed batch of one."""
+        return self.engine.predict(image_input)
+
+    def decide(self, steering_angle):
+        """``(code, value)`` for a normalized steering angle: -threshold, 0 or threshold."""
+        return CMD_TURN, steering_command(int(steering_angle * 100), self.threshold)
+
+    def command(self, frame):
+        return self.decide(self.predict(self.preprocess(frame.image)))
+
+
+class ReplayController(Controller):
+    """Steering values of a recorded drive, one per call, as CMD_TURN commands.
+
+    ``steerings`` is a recorder folder or a sequence of -100..100 values.
+    With a ``threshold`` the values go through the same +-threshold logic
+    as the model's predictions. Stops the car at the end unless ``loop``.
+    """
+
+    def __init__(self, steerings, threshold=None, loop=False):
+        self.source = steerings
+        self.threshold = threshold
+        self.loop = loop
+        self.steerings = None
+        self.position = 0
+
+    def setup(self):
+        if isinstance(self.source, str):
+            self.steerings = [s.steering for s in list_samples(self.source)]
+        else:
+            self.steerings = list(self.source)
+
+    def command(self, frame=None):
+        if self.position >= len(self.steerings):
+            if not self.loop or not self.steerings:
+                return CMD_STOP, 0
+            self.position = 0
+        value = self.steerings[self.position]
+        self.position += 1
+        if self.threshold is not None:
+            value = steering_command(value, self.threshold)
+        return CMD_TURN, int(value)
@@ -0,0 +1,64 @@
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+# One recorded frame. steering is the raw -100..100 value from the filename.
+Sample = namedtuple('Sample', 'path counter steering timestamp')
+
+# Timestamp in the recorder filenames, cut to milliseconds
+TIMESTAMP_FORMAT = "%m-%d-%Y_%H-%M-%S-%f"
+
+
+def format_filename(counter, steering, timestamp):
+    """Recorder filename for a frame; ``timestamp`` is a datetime."""
+    return f"{counter}_{steering}_{timestamp.strftime(TIMESTAMP_FORMAT)[:-3]}.jpg"
+
+
+def parse_timestamp(text):
+    """Filename timestamp -> seconds since the epoch (NaN if it does not parse)."""
+    try:
+        return datetime.strptime(text, TIMESTAMP_FORMAT).timestamp()
+    except ValueError:
+        return float('nan')
+
+
+def parse_filename(filename):
+    """Split a recorder filename ``{counter}_{steering}_{timestamp}.jpg``.
+
+    Returns ``(counter, steering, timestamp)`` or None for files that do not
+    follow the pattern. The timestamp is kept as the recorder wrote it.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    parts = stem.split('_', 2)
+    if len(parts) < 2:
+        return None
+    try:
+        counter = int(parts[0])
+        steering = int(float(parts[1]))
+    except ValueError:
+        return None
+    timestamp = parts[2] if len(parts) > 2 else ''
+    return counter, steering, timestamp
+
+
+def list_samples(folder):
+    """All recorded frames in ``folder``, ordered by counter."""
+    samples = []
+    for filename in os.listdir(folder):
+        if not filename.lower().endswith('.jpg'):
+            continue
+        parsed = parse_filename(filename)
+        if parsed is not None:
+            samples.append(Sample(os.path.join(folder, filename), *parsed))
+    samples.sort(key=lambda s: (s.counter, s.path))
+    return samples
+
+
+def load_steering_dataset(folders):
+    """Image paths and steering angles normalized to [-1, 1], as used for training."""
+    samples = [s for folder in folders for s in list_samples(folder)]
+    image_paths = np.array([s.path for s in samples])
+    steerings = np.array([s.steering / 100 for s in samples], dtype=np.float64)
+    return image_paths, steerings
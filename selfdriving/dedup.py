@@ -0,0 +1,196 @@
+"""Near-duplicate removal for recorded drives.
+
+The car streams far fewer camera frames than the recorder loop saves, and
+a car standing still or driving straight produces runs of frames that are
+practically identical. Each frame gets a 64-bit dHash (a gradient hash of
+a tiny grayscale thumbnail); frames whose hashes differ in at most
+``radius`` bits and that were recorded within ``window`` seconds of each
+other form one cluster, of which only the first frame is kept.
+
+    python -m selfdriving.dedup "tryout_backward_1" --out "tryout_backward_1/unique_images"
+    python -m selfdriving.dedup "tryout_backward_1" --manifest unique.csv
+
+Kept frames are hard-linked into ``--out`` (same file names, so the folder
+can be used for training directly, without using more disk space) or
+listed in a CSV manifest.
+"""
+import argparse
+import csv
+import math
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples, parse_timestamp
+from selfdriving.preprocess import decode_jpeg
+
+HASH_BITS = 64
+RADIUS = 4    # Max differing hash bits for two frames to count as duplicates
+WINDOW = 2.0  # Seconds; frames further apart in time are never merged
+
+
+def dhash(image):
+    """64-bit difference hash of a BGR or grayscale image, as a Python int."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # 1/8 size decode is plenty for a 9x8 thumbnail
+    image = decode_jpeg(data, 8)
+    return None if image is None else dhash(image)
+
+
+def hash_files(paths, workers=None):
+    """dHash of every file (None for files that do not decode), computed on a thread pool."""
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(_hash_file, paths))
+
+
+class HashIndex:
+    """Hamming-radius lookup over 64-bit hashes (multi-index hashing).
+
+    Each hash is split into ``radius + 1`` bands. Two hashes within
+    ``radius`` bits of each other agree exactly on at least one band, so a
+    query only has to compare against the entries sharing a band with it.
+    """
+
+    def __init__(self, radius=RADIUS):
+        self.radius = radius
+        bands = radius + 1
+        widths = [HASH_BITS // bands + (i < HASH_BITS % bands) for i in range(bands)]
+        self._bands = []  # (shift, mask) of every band
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._bands]
+        self._hashes = {}  # id -> hash
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self._bands]
+
+    def add(self, key, value):
+        self._hashes[key] = value
+        for table, band in zip(self._tables, self._keys(value)):
+            table.setdefault(band, set()).add(key)
+
+    def remove(self, key):
+        value = self._hashes.pop(key)
+        for table, band in zip(self._tables, self._keys(value)):
+            entries = table[band]
+            entries.discard(key)
+            if not entries:
+                del table[band]
+
+    def query(self, value):
+        """Ids of every entry within ``radius`` bits of ``value``, closest first."""
+        candidates = set()
+        for table, band in zip(self._tables, self._keys(value)):
+            candidates.update(table.get(band, ()))
+        matches = []
+        for key in candidates:
+            distance = (self._hashes[key] ^ value).bit_count()
+            if distance <= self.radius:
+                matches.append((distance, key))
+        return [key for _, key in sorted(matches)]
+
+
+def find_unique(samples, hashes, radius=RADIUS, window=WINDOW):
+    """Split time-ordered samples into clusters; returns ``{kept index: [indices of its cluster]}``.
+
+    Frames that did not decode are dropped. Frames without a parsable
+    timestamp are treated as recorded at the time of the frame before them.
+    """
+    index = HashIndex(radius)
+    recent = deque()  # (time, index) of kept frames still inside the window
+    clusters = {}
+    now = -math.inf
+    for i, (sample, value) in enumerate(zip(samples, hashes)):
+        if value is None:
+            continue
+        stamp = parse_timestamp(sample.timestamp)
+        if not math.isnan(stamp):
+            now = stamp
+        while recent and now - recent[0][0] > window:
+            index.remove(recent.popleft()[1])
+
+        matches = index.query(value)
+        if matches:
+            clusters[matches[0]].append(i)
+        else:
+            clusters[i] = [i]
+            index.add(i, value)
+            recent.append((now, i))
+    return clusters
+
+
+def link_files(paths, folder):
+    """Hard-link ``paths`` into ``folder`` (copies when linking is not possible, e.g. across drives)."""
+    os.makedirs(folder, exist_ok=True)
+    copied = 0
+    for path in paths:
+        dest = os.path.join(folder, os.path.basename(path))
+        if os.path.exists(dest):
+            continue
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copy2(path, dest)
+            copied += 1
+    if copied:
+        print(f"[WARN] Could not hard-link {copied} files, copied them instead")
+
+
+def write_manifest(path, samples, clusters):
+    """CSV of the kept frames with their steering and how many recorded frames each one stands for."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'steering', 'cluster_size'])
+        for kept, members in clusters.items():
+            writer.writerow([samples[kept].path, samples[kept].steering, len(members)])
+
+
+def dedup(folder, out=None, manifest=None, radius=RADIUS, window=WINDOW, workers=None):
+    """Find near-duplicates in a recorded folder; link and/or list the kept frames. Returns (kept, total)."""
+    samples = list_samples(folder)
+    hashes = hash_files([s.path for s in samples], workers)
+    clusters = find_unique(samples, hashes, radius, window)
+    kept = [samples[i].path for i in clusters]
+    if out is not None:
+        link_files(kept, out)
+    if manifest is not None:
+        write_manifest(manifest, samples, clusters)
+    return len(kept), len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove near-duplicate frames from a recorded drive.")
+    parser.add_argument('folder')
+    parser.add_argument('--out', help="Folder to hard-link the kept frames into")
+    parser.add_argument('--manifest', help="CSV file listing the kept frames")
+    parser.add_argument('--radius', type=int, default=RADIUS, help="Max differing hash bits (0-63)")
+    parser.add_argument('--window', type=float, default=WINDOW, help="Seconds within which frames are compared")
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+    if args.out is None and args.manifest is None:
+        parser.error("give --out and/or --manifest")
+
+    kept, total = dedup(args.folder, args.out, args.manifest, args.radius, args.window, args.workers)
+    print(f"[OK] Kept {kept} of {total} frames ({total - kept} near-duplicates)")
+
+
+if __name__ == "__main__":
+    main()
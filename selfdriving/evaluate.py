@@ -0,0 +1,179 @@
+"""Offline evaluation of steering models on recorded drives.
+
+    python -m selfdriving.evaluate --data "12 Laps perfected new/backward_images" \
+        --model new_non_golay_model_2.h5 golay_model_2.h5
+
+Every frame is preprocessed once into a TensorCache and every model runs
+on the frames in large batches. Predictions are stored per model (keyed
+by a hash of the model file) and per cache row, so re-running after
+recording more data or adding a model only predicts what is new. Data can
+be recorder folders or shard folders (see ``selfdriving.shards``).
+
+For each model the report has the MSE against the recorded steering, the
+error per steering bin, how often the thresholded turn command the
+deployment script would send matches the one from the human label, and
+the inference speed in frames per second.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from selfdriving.cache import TensorCache, content_hash
+from selfdriving.control import TURN_THRESHOLD, steering_command
+from selfdriving.dataset import list_samples
+from selfdriving.shards import ShardDataset
+
+NUM_BINS = 10  # Equal-width steering bins over -1..1 for the per-bin error
+CACHE_FOLDER = '.eval_cache'
+
+
+def load_data(folders, cache, workers=None):
+    """Cache rows and normalized steering labels of every frame in recorder and/or shard folders.
+
+    Also returns how many frames had to be preprocessed.
+    """
+    rows, labels = [], []
+    new = 0
+    for folder in folders:
+        if glob.glob(os.path.join(folder, 'shard-*.idx')):
+            dataset = ShardDataset(folder)
+            rows.append(cache.build_jpegs([dataset.jpeg(i) for i in range(len(dataset))], workers))
+            labels.append(dataset.steering / 100)
+        else:
+            samples = list_samples(folder)
+            rows.append(cache.build([s.path for s in samples], workers))
+            labels.append(np.array([s.steering / 100 for s in samples]))
+        new += cache.misses
+    rows = np.concatenate(rows) if rows else np.zeros(0, np.int64)
+    labels = np.concatenate(labels) if labels else np.zeros(0)
+    valid = rows >= 0  # Drop frames that did not decode
+    return rows[valid], labels[valid].astype(np.float32), new
+
+
+def model_hash(model_path):
+    with open(model_path, 'rb') as f:
+        return content_hash(f.read())
+
+
+class PredictionStore:
+    """Predictions of one model for every TensorCache row, NaN where not computed yet."""
+
+    def __init__(self, cache, key):
+        self.path = os.path.join(cache.folder, f'predictions-{key}.f4')
+        self.values = np.full(len(cache), np.nan, np.float32)
+        if os.path.exists(self.path):
+            saved = np.fromfile(self.path, np.float32)[:len(cache)]
+            self.values[:len(saved)] = saved
+
+    def missing(self, rows):
+        return np.unique(rows[np.isnan(self.values[rows])])
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        self.values.tofile(tmp)
+        os.replace(tmp, self.path)
+
+
+def predict_rows(engine, cache, rows, store, batch_size=256):
+    """Predict the given cache rows into ``store``; returns frames per second."""
+    batch = np.empty((batch_size,) + cache.tensors.shape[1:], np.float32)
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        chunk = rows[i:i + batch_size]
+        images = cache.batch(chunk, out=batch[:len(chunk)])
+        store.values[chunk] = engine.predict_batch(images)
+    elapsed = time.perf_counter() - start
+    store.save()
+    return len(rows) / elapsed if elapsed > 0 else None
+
+
+def metrics(predictions, labels, num_bins=NUM_BINS, threshold=TURN_THRESHOLD):
+    """Error statistics of normalized predictions against normalized labels."""
+    errors = predictions - labels
+    edges = np.linspace(-1, 1, num_bins + 1)
+    bins = np.clip(np.digitize(labels, edges[1:-1]), 0, num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    squared = np.bincount(bins, weights=errors.astype(np.float64) ** 2, minlength=num_bins)
+
+    # Same conversion as the deployment script: int(angle * 100), then the +-threshold logic
+    predicted_cmd = steering_command(np.trunc(predictions * 100), threshold)
+    label_cmd = steering_command(np.rint(labels * 100), threshold)
+    commands = (-threshold, 0, threshold)
+    confusion = [[int(np.count_nonzero((label_cmd == a) & (predicted_cmd == b))) for b in commands] for a in commands]
+
+    return {
+        'frames': len(labels),
+        'mse': float(np.mean(errors ** 2)),
+        'mae': float(np.mean(np.abs(errors))),
+        'bins': [
+            {'range': [float(edges[i]), float(edges[i + 1])], 'frames': int(counts[i]),
+             'mse': float(squared[i] / counts[i]) if counts[i] else None}
+            for i in range(num_bins)
+        ],
+        'command_agreement': float(np.mean(predicted_cmd == label_cmd)),
+        # Rows: command from the label, columns: command from the model, both ordered left, straight, right
+        'command_confusion': confusion,
+    }
+
+
+def evaluate(model_paths, folders, cache_folder=CACHE_FOLDER, backend='auto', batch_size=256,
+             num_bins=NUM_BINS, threshold=TURN_THRESHOLD, workers=None):
+    """Evaluate every model on the recorded frames in ``folders``; returns {model path: report}."""
+    cache = TensorCache(cache_folder)
+    rows, labels, new = load_data(folders, cache, workers)
+    print(f"[INFO] {len(rows)} frames ({new} newly preprocessed)")
+
+    reports = {}
+    for model_path in model_paths:
+        store = PredictionStore(cache, model_hash(model_path))
+        missing = store.missing(rows)
+        fps = None
+        if len(missing):
+            from selfdriving.inference import load_engine
+            engine = load_engine(model_path, backend)
+            fps = predict_rows(engine, cache, missing, store, batch_size)
+        report = metrics(store.values[rows], labels, num_bins, threshold)
+        report.update(predicted=int(len(missing)), fps=fps)
+        reports[model_path] = report
+    return reports
+
+
+def print_report(reports):
+    print(f"{'model':<40}{'frames':>8}{'MSE':>10}{'MAE':>8}{'cmd agree':>11}{'new':>7}{'fps':>8}")
+    for path, r in reports.items():
+        fps = f"{r['fps']:.0f}" if r['fps'] else 'cached'
+        print(f"{os.path.basename(path)[:39]:<40}{r['frames']:>8}{r['mse']:>10.5f}{r['mae']:>8.4f}"
+              f"{r['command_agreement']:>11.1%}{r['predicted']:>7}{fps:>8}")
+    for path, r in reports.items():
+        print(f"\n{os.path.basename(path)} - MSE per steering bin:")
+        for b in r['bins']:
+            if b['frames']:
+                print(f"  [{b['range'][0]:+.1f}, {b['range'][1]:+.1f})  {b['frames']:>7} frames  MSE {b['mse']:.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate steering models on recorded drives.")
+    parser.add_argument('--model', nargs='+', required=True, help="Keras .h5 weights or .tflite models")
+    parser.add_argument('--data', nargs='+', required=True, help="Recorder folders or shard folders")
+    parser.add_argument('--cache', default=CACHE_FOLDER, help="Folder for preprocessed frames and predictions")
+    parser.add_argument('--backend', default='auto', help="Inference backend, see selfdriving.inference")
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--bins', type=int, default=NUM_BINS)
+    parser.add_argument('--threshold', type=int, default=TURN_THRESHOLD)
+    parser.add_argument('--json', help="Also save the full report to this file")
+    args = parser.parse_args()
+
+    reports = evaluate(args.model, args.data, args.cache, args.backend, args.batch_size, args.bins, args.threshold)
+    print_report(reports)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+        print(f"[OK] Report saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# seq: stream sequence number (1, 2, 3, ...), stamp: time.monotonic() at publish
+Frame = namedtuple('Frame', 'seq image stamp meta')
+
+
+class FrameRing:
+    """Latest-frame-only hand-off between the stream thread and the control loop.
+
+    The ring keeps three preallocated image buffers (triple buffering): one
+    the consumer is holding, one with the newest published frame and one
+    the producer writes into. The producer never blocks and never waits for
+    the consumer; a frame that is replaced before anyone took it is counted
+    as dropped. The consumer gets the buffer itself rather than a copy and
+    may use it until its next call to ``get``. When the frame shape changes
+    (e.g. a different decode scale) each slot is reallocated only when it
+    is next written, so the published and held frames stay intact.
+
+    Meant for one producer thread and one consumer thread.
+    """
+
+    SLOTS = 3
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buffers = [None] * self.SLOTS
+        self._published = -1  # Slot index of the newest frame, -1 if none yet
+        self._held = -1       # Slot index the consumer is currently using
+        self._writing = -1    # Slot index handed out by acquire()
+        self._seq = 0
+        self._stamp = 0.0
+        self._meta = None
+        self._taken = True    # Whether the newest frame was already consumed
+        self._closed = False
+
+        # Counters
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+
+    # --- Producer side ---
+
+    def acquire(self, shape, dtype=np.uint8):
+        """Return a free buffer to write the next frame into.
+
+        Lets the producer decode or flip straight into preallocated memory,
+        e.g. ``cv2.flip(img, 0, dst=ring.acquire(img.shape))``, then call
+        ``publish()``.
+        """
+        with self._cond:
+            busy = (self._published, self._held)
+            self._writing = next(i for i in range(self.SLOTS) if i not in busy)
+            buffer = self._buffers[self._writing]
+            if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+                buffer = self._buffers[self._writing] = np.empty(shape, dtype)
+            return buffer
+
+    def publish(self, meta=None):
+        """Make the buffer from the last acquire() the newest frame; returns its sequence number."""
+        with self._cond:
+            if self._writing < 0:
+                raise RuntimeError("publish() called without acquire()")
+            if not self._taken:
+                self.dropped += 1
+            self._published = self._writing
+            self._writing = -1
+            self._seq += 1
+            self._stamp = time.monotonic()
+            self._meta = meta
+            self._taken = False
+            self.produced += 1
+            self._cond.notify_all()
+            return self._seq
+
+    def put(self, image, meta=None):
+        """Copy ``image`` into the ring and publish it."""
+        np.copyto(self.acquire(image.shape, image.dtype), image)
+        return self.publish(meta)
+
+    def close(self):
+        """Wake up a waiting consumer; further get() calls return None once drained."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    # --- Consumer side ---
+
+    @property
+    def seq(self):
+        """Sequence number of the newest published frame (0 before the first one)."""
+        return self._seq
+
+    def get(self, after=0, timeout=None):
+        """Return the newest Frame with ``seq > after``.
+
+        Waits up to ``timeout`` seconds for one to be published (``None``
+        waits forever, ``0`` does not wait) and returns None on timeout or
+        when the ring is closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after or self._closed, timeout):
+                return None
+            if self._seq <= after:
+                return None
+            self._held = self._published
+            if not self._taken:
+                self._taken = True
+                self.consumed += 1
+            return Frame(self._seq, self._buffers[self._held], self._stamp, self._meta)
+
+    def stats(self):
+        """Counters as a dict, plus how many frames the consumer is behind right now."""
+        with self._cond:
+            return {
+                'produced': self.produced,
+                'consumed': self.consumed,
+                'dropped': self.dropped,
+                'pending': 0 if self._taken else 1,
+                'age': time.monotonic() - self._stamp if self._seq else None,
+            }
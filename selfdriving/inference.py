@@ -0,0 +1,257 @@
+import time
+
+import numpy as np
+
+from selfdriving.preprocess import IMG_HEIGHT, IMG_WIDTH
+
+INPUT_SHAPE = (1, IMG_HEIGHT, IMG_WIDTH, 3)
+
+# (filters, kernel size, stride) of the convolutions in the NVIDIA model
+NVIDIA_CONVS = [(24, 5, 2), (36, 5, 2), (48, 5, 2), (64, 3, 1), (64, 3, 1)]
+NVIDIA_DENSE = [100, 50, 10, 1]
+
+
+def create_model():
+    """The NVIDIA steering model, same layers as nvidia_model() in the training notebook."""
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Input, Conv2D, Flatten, Dense
+
+    layers = [Input(shape=INPUT_SHAPE[1:])]
+    for filters, kernel, stride in NVIDIA_CONVS:
+        layers.append(Conv2D(filters, (kernel, kernel), strides=(stride, stride), activation='relu'))
+    layers.append(Flatten())
+    for units in NVIDIA_DENSE[:-1]:
+        layers.append(Dense(units, activation='relu'))
+    layers.append(Dense(NVIDIA_DENSE[-1]))
+    return Sequential(layers)
+
+
+class LatencyStats:
+    """Keeps the last ``size`` latencies (seconds) in a preallocated array."""
+
+    def __init__(self, size=4096):
+        self._samples = np.zeros(size)
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def add(self, seconds):
+        self._samples[self.count % len(self._samples)] = seconds
+        self.count += 1
+
+    def percentiles(self, *qs):
+        """Latency percentiles in milliseconds, e.g. percentiles(50, 99) -> {'p50': .., 'p99': ..}."""
+        qs = qs or (50, 99)
+        n = min(self.count, len(self._samples))
+        if n == 0:
+            return {f'p{q}': None for q in qs}
+        values = np.percentile(self._samples[:n], qs) * 1000
+        return {f'p{q}': float(v) for q, v in zip(qs, values)}
+
+    def summary(self):
+        p = self.percentiles(50, 99)
+        if p['p50'] is None:
+            return "no samples"
+        return f"p50 {p['p50']:.2f} ms, p99 {p['p99']:.2f} ms over {min(self.count, len(self._samples))} calls"
+
+
+class InferenceEngine:
+    """Runs the steering model on one (1, 66, 200, 3) float32 frame at a time.
+
+    Subclasses set everything up once in ``__init__`` and implement
+    ``_run``. ``predict`` takes the batch produced by ``Preprocessor`` and
+    returns the normalized steering angle as a float; anything else is
+    first copied into the preallocated ``input`` buffer.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.input = np.zeros(INPUT_SHAPE, np.float32)
+        self.latency = LatencyStats()
+
+    def predict(self, batch):
+        if batch.dtype != np.float32 or batch.shape != INPUT_SHAPE:
+            np.copyto(self.input, np.reshape(batch, INPUT_SHAPE), casting='unsafe')
+            batch = self.input
+        start = time.perf_counter()
+        value = self._run(batch)
+        self.latency.add(time.perf_counter() - start)
+        return value
+
+    def warmup(self, runs=3):
+        """Run ``runs`` predictions on a blank frame; returns the seconds each one took.
+
+        The first call pays for graph tracing, memory allocation and kernel
+        selection. Doing it here keeps that out of the first real frame, and
+        the latency statistics are reset afterwards so they only cover real
+        frames.
+        """
+        blank = np.zeros(INPUT_SHAPE, np.float32)
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self.predict(blank)
+            times.append(time.perf_counter() - start)
+        self.latency.reset()
+        return times
+
+    def predict_batch(self, images):
+        """Steering angles for a (N, 66, 200, 3) float32 batch, as a float32 array.
+
+        Meant for offline work on many frames; subclasses run the whole
+        batch at once where the backend allows it.
+        """
+        images = np.asarray(images, np.float32)
+        return np.array([self._run(images[i:i + 1]) for i in range(len(images))], np.float32)
+
+    def _run(self, batch):
+        raise NotImplementedError
+
+
+class KerasEngine(InferenceEngine):
+    """Keras model wrapped in a tf.function traced once for the fixed input signature."""
+
+    name = 'keras'
+
+    def __init__(self, model_path):
+        super().__init__()
+        import tensorflow as tf
+
+        # Allocate GPU memory as needed instead of grabbing all of it up front
+        for gpu in tf.config.list_physical_devices('GPU'):
+            try:
+                tf.config.experimental.set_memory_growth(gpu, True)
+            except RuntimeError as e:  # GPU already initialized
+                print(e)
+
+        # Weights only: no load_model, no compile, the optimizer is never used for inference
+        model = create_model()
+        model.load_weights(model_path)
+        self.model = model
+        self._fn = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec(INPUT_SHAPE, tf.float32)],
+        )
+        self._batch_fn = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE[1:], tf.float32)],
+        )
+
+    def _run(self, batch):
+        return float(self._fn(batch).numpy()[0, 0])
+
+    def predict_batch(self, images):
+        return self._batch_fn(np.asarray(images, np.float32)).numpy()[:, 0]
+
+
+class TFLiteEngine(InferenceEngine):
+    """A .tflite model; uses the small LiteRT (ai_edge_litert) or tflite_runtime
+    package when one is installed and only falls back to full TensorFlow."""
+
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None):
+        super().__init__()
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+
+        self._interpreter = Interpreter(model_path=str(model_path), num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+
+    def _run(self, batch):
+        self._interpreter.set_tensor(self._input['index'], batch)
+        self._interpreter.invoke()
+        return float(self._interpreter.get_tensor(self._output['index'])[0, 0])
+
+
+def load_h5_weights(model_path):
+    """Read [(kernel, bias), ...] per layer from a Keras .h5 weights file, in layer order."""
+    import h5py
+
+    layers = []
+    with h5py.File(model_path, 'r') as f:
+        root = f['model_weights'] if 'model_weights' in f else f
+        for layer_name in root.attrs['layer_names']:
+            layer_name = layer_name.decode() if isinstance(layer_name, bytes) else layer_name
+            group = root[layer_name]
+            names = [n.decode() if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            if names:
+                weights = {n.rsplit('/', 1)[-1].split(':')[0]: group[n][()] for n in names}
+                layers.append((weights['kernel'], weights['bias']))
+    return layers
+
+
+class NumpyEngine(InferenceEngine):
+    """Forward pass of the NVIDIA model in plain NumPy, no TensorFlow needed.
+
+    Convolutions are done as one matrix product over strided sliding
+    windows, which is plenty for a 66x200 input on a laptop CPU.
+    """
+
+    name = 'numpy'
+
+    def __init__(self, model_path):
+        super().__init__()
+        layers = load_h5_weights(model_path)
+        if len(layers) != len(NVIDIA_CONVS) + len(NVIDIA_DENSE):
+            raise ValueError(f"{model_path} does not look like the NVIDIA model ({len(layers)} layers)")
+        convs = layers[:len(NVIDIA_CONVS)]
+        self._convs = []
+        for (kernel, bias), (_, size, stride) in zip(convs, NVIDIA_CONVS):
+            # (kh, kw, C, F) -> (C, kh, kw, F) to match the sliding window axis order
+            self._convs.append((np.ascontiguousarray(kernel.transpose(2, 0, 1, 3), np.float32),
+                                bias.astype(np.float32), size, stride))
+        self._dense = [(k.astype(np.float32), b.astype(np.float32)) for k, b in layers[len(NVIDIA_CONVS):]]
+
+    def forward(self, x):
+        """Steering angles for a (N, 66, 200, 3) float32 batch."""
+        for kernel, bias, size, stride in self._convs:
+            windows = np.lib.stride_tricks.sliding_window_view(x, (size, size), axis=(1, 2))
+            windows = windows[:, ::stride, ::stride]  # (N, H', W', C, kh, kw)
+            x = np.tensordot(windows, kernel, axes=3)
+            x += bias
+            np.maximum(x, 0, out=x)
+        x = x.reshape(len(x), -1)
+        for i, (kernel, bias) in enumerate(self._dense):
+            x = x @ kernel + bias
+            if i < len(self._dense) - 1:
+                np.maximum(x, 0, out=x)
+        return x[:, 0]
+
+    def _run(self, batch):
+        return float(self.forward(batch)[0])
+
+    def predict_batch(self, images, chunk_size=32):
+        # The sliding windows of the first convolution take ~1 MB per image, so go in chunks
+        images = np.asarray(images, np.float32)
+        return np.concatenate([self.forward(images[i:i + chunk_size])
+                               for i in range(0, len(images), chunk_size)] or [np.zeros(0, np.float32)])
+
+
+BACKENDS = {
+    'keras': KerasEngine,
+    'tflite': TFLiteEngine,
+    'numpy': NumpyEngine,
+}
+
+
+def load_engine(model_path, backend='auto'):
+    """Create the inference engine for ``model_path``.
+
+    ``backend='auto'`` picks tflite for .tflite files and keras otherwise.
+    """
+    if backend == 'auto':
+        backend = 'tflite' if str(model_path).endswith('.tflite') else 'keras'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, choose from {', '.join(BACKENDS)}")
+    return BACKENDS[backend](model_path)
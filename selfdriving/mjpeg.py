@@ -0,0 +1,124 @@
+import re
+
+SOI = b'\xff\xd8'  # JPEG start of image
+EOI = b'\xff\xd9'  # JPEG end of image
+
+# Every firmware sketch sends "--frame\r\nContent-Type: image/jpeg\r\nContent-Length: N\r\n\r\n"
+# in front of each JPEG, see stream_handler in the .ino files.
+_CONTENT_LENGTH = re.compile(rb'Content-Length:\s*(\d+)', re.IGNORECASE)
+
+MAX_FRAME_SIZE = 1 << 20  # Give up on a frame that grows past 1 MB (lost sync)
+
+
+class MJPEGParser:
+    """Incremental parser for the ESP32 multipart/x-mixed-replace stream.
+
+    Feed it raw chunks from ``resp.iter_content()`` and it returns every
+    complete JPEG found so far as a ``memoryview`` into its own buffer, so
+    no frame bytes are copied. Scanning resumes where the previous call
+    stopped, which keeps the cost per chunk constant regardless of frame
+    size. When a part header carries ``Content-Length`` the frame is cut
+    by length; otherwise the parser falls back to the SOI/EOI markers.
+
+    A returned view stays valid as long as it is referenced; call
+    ``bytes(frame)`` only if the JPEG has to outlive the frame loop.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._start = 0     # First byte not yet consumed (start of the part header)
+        self._scan = 0      # Where the next marker search resumes
+        self._soi = -1      # Offset of the current frame's SOI, -1 if not found yet
+        self._length = None  # Content-Length of the current frame, if announced
+
+        # Counters
+        self.frames = 0
+        self.bytes = 0
+        self.resyncs = 0
+
+    def _append(self, chunk):
+        # Drop consumed bytes and append the new chunk. Views handed out
+        # earlier pin the bytearray (it cannot be resized while exported),
+        # in that case move the unconsumed tail into a fresh buffer instead.
+        start = self._start
+        try:
+            if start:
+                del self._buf[:start]
+            self._buf += chunk
+        except BufferError:
+            buf = bytearray(memoryview(self._buf)[start:])
+            buf += chunk
+            self._buf = buf
+        self._start = 0
+        self._scan -= start
+        if self._soi >= 0:
+            self._soi -= start
+
+    def _resync(self):
+        self.resyncs += 1
+        self._start = self._scan = len(self._buf)
+        self._soi = -1
+        self._length = None
+
+    def feed(self, chunk):
+        """Add a chunk of stream data and return the list of completed frames."""
+        self.bytes += len(chunk)
+        self._append(chunk)
+        buf = self._buf
+        size = len(buf)
+        frames = []
+
+        while True:
+            if self._soi < 0:
+                soi = buf.find(SOI, self._scan)
+                if soi < 0:
+                    # Keep the last byte, it may be the first half of a marker
+                    self._scan = max(self._start, size - 1)
+                    break
+                self._soi = soi
+                self._scan = soi + 2
+                header = _CONTENT_LENGTH.search(buf, self._start, soi)
+                self._length = int(header.group(1)) if header else None
+
+            if self._length is not None:
+                end = self._soi + self._length
+                if size < end:
+                    break
+                if buf[end - 2] != 0xFF or buf[end - 1] != 0xD9:
+                    # Length does not match the payload, trust the markers instead
+                    self._length = None
+                    continue
+            else:
+                eoi = buf.find(EOI, self._scan)
+                if eoi < 0:
+                    self._scan = max(self._soi + 2, size - 1)
+                    break
+                end = eoi + 2
+
+            frames.append(memoryview(buf)[self._soi:end])
+            self.frames += 1
+            self._start = self._scan = end
+            self._soi = -1
+            self._length = None
+
+        if size - self._start > self.max_frame_size:
+            self._resync()
+        return frames
+
+
+def iter_frames(chunks, parser=None):
+    """Yield every JPEG frame (as a memoryview) found in an iterable of chunks."""
+    parser = parser or MJPEGParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+
+def iter_latest_frames(chunks, parser=None):
+    """Like iter_frames, but when one chunk completes several frames only the
+    newest is yielded. Live viewers and the autopilot never want the older ones."""
+    parser = parser or MJPEGParser()
+    for chunk in chunks:
+        frames = parser.feed(chunk)
+        if frames:
+            yield frames[-1]
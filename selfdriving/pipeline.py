@@ -0,0 +1,133 @@
+"""Parallel, prefetching input pipeline for training.
+
+    pipeline = BatchPipeline(from_cache(cache, train_rows), y_train, BATCH_SIZE,
+                             augment=augment_batch, seed=42)
+    model.fit(iter(pipeline), steps_per_epoch=len(pipeline), ...)
+
+Every epoch visits each sample exactly once, in an order drawn from
+``seed`` and the epoch number, so two runs with the same seed see the same
+batches. Batches are built on a thread pool (OpenCV and NumPy release the
+GIL) and kept ``prefetch`` batches ahead of the trainer, across epoch
+boundaries too. At the end of each epoch the pipeline prints how many
+samples per second were consumed and how long the consumer had to wait
+for data.
+"""
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from selfdriving.preprocess import preprocess_uint8
+
+
+def from_cache(cache, rows):
+    """Loader for BatchPipeline reading preprocessed images from a TensorCache."""
+    rows = np.asarray(rows)
+    return lambda indices: cache.tensors[rows[indices]]
+
+
+def from_files(image_paths):
+    """Loader for BatchPipeline decoding and preprocessing JPEG files on the fly."""
+    image_paths = np.asarray(image_paths)
+    return lambda indices: np.stack([preprocess_uint8(cv2.imread(str(p))) for p in image_paths[indices]])
+
+
+class BatchPipeline:
+    """Endless iterator of (float32 images, float32 steerings) batches.
+
+    ``load(indices)`` returns the uint8 (N, 66, 200, 3) YUV images of the
+    given samples. ``augment(images, steerings, rng)``, if given, returns
+    augmented copies of both; ``rng`` is a NumPy Generator seeded per batch
+    so results do not depend on thread scheduling.
+    """
+
+    def __init__(self, load, steerings, batch_size, augment=None, shuffle=True, seed=0,
+                 workers=None, prefetch=8, drop_remainder=True, name='train', verbose=True):
+        self.load = load
+        self.steerings = np.asarray(steerings, np.float32)
+        self.batch_size = batch_size
+        self.augment = augment
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch = prefetch
+        self.drop_remainder = drop_remainder
+        self.name = name
+        self.verbose = verbose
+        if len(self) == 0:
+            # Would never yield a batch, and iterate() without epochs would spin forever
+            hint = "; use a smaller batch_size or drop_remainder=False" if len(self.steerings) else ""
+            raise ValueError(f"{name}: {len(self.steerings)} samples make no batch of {batch_size}{hint}")
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix=f'pipeline-{name}')
+
+        # Stats of the last finished epoch
+        self.samples_per_second = None
+        self.wait_fraction = None
+
+    def __len__(self):
+        """Batches per epoch, use as steps_per_epoch / validation_steps."""
+        n = len(self.steerings)
+        return n // self.batch_size if self.drop_remainder else -(-n // self.batch_size)
+
+    def order(self, epoch):
+        """Sample indices of ``epoch`` in the order they are served."""
+        n = len(self.steerings)
+        if not self.shuffle:
+            return np.arange(n)
+        return np.random.default_rng([self.seed, epoch]).permutation(n)
+
+    def _jobs(self, epochs):
+        for epoch in (itertools.count() if epochs is None else range(epochs)):
+            order = self.order(epoch)
+            for b in range(len(self)):
+                yield epoch, b, order[b * self.batch_size:(b + 1) * self.batch_size]
+
+    def _make_batch(self, epoch, b, indices):
+        images = self.load(indices)
+        steerings = self.steerings[indices]
+        if self.augment is not None:
+            rng = np.random.default_rng([self.seed, epoch, b])
+            images, steerings = self.augment(images, steerings, rng)
+        batch = np.multiply(images, np.float32(1 / 255.0), dtype=np.float32)
+        return batch, np.asarray(steerings, np.float32)
+
+    def iterate(self, epochs=None):
+        """Yield batches for ``epochs`` epochs (forever if None)."""
+        jobs = self._jobs(epochs)
+        pending = deque()
+        for job in itertools.islice(jobs, self.prefetch):
+            pending.append((job[0], job[1], self._pool.submit(self._make_batch, *job)))
+
+        epoch_start = time.perf_counter()
+        waited = 0.0
+        samples = 0
+        while pending:
+            epoch, b, future = pending.popleft()
+            start = time.perf_counter()
+            batch = future.result()
+            waited += time.perf_counter() - start
+            samples += len(batch[1])
+            job = next(jobs, None)
+            if job is not None:
+                pending.append((job[0], job[1], self._pool.submit(self._make_batch, *job)))
+
+            if b == len(self) - 1:
+                # Report when handing out the last batch of the epoch
+                elapsed = time.perf_counter() - epoch_start
+                self.samples_per_second = samples / elapsed
+                self.wait_fraction = waited / elapsed
+                if self.verbose:
+                    print(f"[{self.name}] epoch {epoch + 1}: {self.samples_per_second:.0f} samples/s, "
+                          f"waited for data {self.wait_fraction:.0%} of the time")
+                epoch_start = time.perf_counter()
+                waited = 0.0
+                samples = 0
+            yield batch
+
+    def __iter__(self):
+        return self.iterate()
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
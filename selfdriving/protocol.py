@@ -0,0 +1,248 @@
+"""Framed command protocol between the host and the car (5_self_driving.ino).
+
+The original protocol is a bare 3-byte ``>bh`` packet (command code,
+value). Version 1 frames add what is needed to bound command latency:
+
+    offset  size  field
+    0       1     MAGIC (0xA5; a legacy packet never starts with it)
+    1       1     VERSION
+    2       1     message type: COMMAND, HEARTBEAT or ACK
+    3       1     flags: FLAG_ACK (ack requested), FLAG_THROTTLE (throttle is set)
+    4       2     sequence number, wraps at 65536
+    6       4     host timestamp, milliseconds, wraps
+    10      1     command code (CMD_STOP, CMD_FWD, CMD_TURN)
+    11      2     steering value -100..100
+    13      2     throttle 0..100 (only used with FLAG_THROTTLE)
+    15      1     XOR of bytes 0..14
+
+all big-endian. The firmware applies only the newest command when
+several frames are waiting, stops the motors when no frame arrived for
+its watchdog time (so the host sends HEARTBEATs while idle), and answers
+frames with FLAG_ACK with an ACK frame: same header, host timestamp
+echoed and the firmware's micros() at receive time in place of the
+command fields. HEARTBEATs carry the host's current command, which the
+firmware applies again only if its watchdog had stopped the car: the
+host skips repeated commands, so after a network stall longer than the
+watchdog the car would otherwise stay stopped until the steering changes.
+
+    client = CommandClient('192.168.4.1', ack=True)
+    client.send(CMD_TURN, 16)
+    ...
+    print(client.rtt.summary())
+    client.close()
+"""
+import socket
+import struct
+import threading
+import time
+
+from selfdriving.inference import LatencyStats
+
+MAGIC = 0xA5
+VERSION = 1
+
+# Message types
+COMMAND = 1
+HEARTBEAT = 2
+ACK = 3
+
+# Flags
+FLAG_ACK = 0x01
+FLAG_THROTTLE = 0x02
+
+# Command codes, as in the firmware
+CMD_STOP = 0
+CMD_FWD = 1
+CMD_TURN = 2
+
+FRAME = struct.Struct('>BBBBHIbhh')   # Without the checksum byte
+ACK_FRAME = struct.Struct('>BBBBHII')
+FRAME_SIZE = FRAME.size + 1          # 16
+ACK_SIZE = ACK_FRAME.size + 1        # 15
+LEGACY = struct.Struct('>bh')
+
+HEARTBEAT_INTERVAL = 0.1  # Seconds without a frame before the host sends a heartbeat
+WATCHDOG = 0.5            # Seconds without a frame before the firmware stops the motors
+
+
+def checksum(data):
+    value = 0
+    for byte in data:
+        value ^= byte
+    return value
+
+
+def host_millis():
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+
+def encode(msg_type, seq, code=0, steering=0, throttle=None, ack=False, stamp=None):
+    """One protocol frame as bytes."""
+    flags = (FLAG_ACK if ack else 0) | (FLAG_THROTTLE if throttle is not None else 0)
+    stamp = host_millis() if stamp is None else stamp
+    body = FRAME.pack(MAGIC, VERSION, msg_type, flags, seq & 0xFFFF, stamp,
+                      code, steering, 0 if throttle is None else throttle)
+    return body + bytes([checksum(body)])
+
+
+def decode(data):
+    """Parse a COMMAND/HEARTBEAT frame: dict of its fields, or None if it is not a valid frame."""
+    if len(data) != FRAME_SIZE or data[0] != MAGIC or checksum(data[:-1]) != data[-1]:
+        return None
+    _, version, msg_type, flags, seq, stamp, code, steering, throttle = FRAME.unpack(data[:-1])
+    if version != VERSION:
+        return None
+    return {'type': msg_type, 'flags': flags, 'seq': seq, 'stamp': stamp, 'code': code,
+            'steering': steering, 'throttle': throttle if flags & FLAG_THROTTLE else None}
+
+
+def encode_ack(seq, stamp, device_micros):
+    body = ACK_FRAME.pack(MAGIC, VERSION, ACK, 0, seq, stamp, device_micros & 0xFFFFFFFF)
+    return body + bytes([checksum(body)])
+
+
+def decode_ack(data):
+    """(seq, echoed host timestamp, firmware micros) of an ACK frame, or None."""
+    if len(data) != ACK_SIZE or data[0] != MAGIC or checksum(data[:-1]) != data[-1]:
+        return None
+    _, version, msg_type, _, seq, stamp, device_micros = ACK_FRAME.unpack(data[:-1])
+    if version != VERSION or msg_type != ACK:
+        return None
+    return seq, stamp, device_micros
+
+
+class CommandClient:
+    """Command connection to the car.
+
+    ``send`` skips a command identical to the previous one, like the old
+    ``send_cmd``; a heartbeat thread keeps the firmware watchdog fed
+    meanwhile, but only while ``send`` keeps being called: when the
+    control loop hangs for longer than WATCHDOG the heartbeats stop, the
+    firmware stops the car and the next command is sent even if it
+    repeats the last one. With ``ack=True`` every frame asks for an ACK and the round
+    trip times go to ``rtt``. ``legacy=True`` speaks the old 3-byte
+    protocol (no heartbeat, no acks) for firmware that predates the frames.
+    """
+
+    def __init__(self, host, port=8000, ack=False, heartbeat=HEARTBEAT_INTERVAL, legacy=False, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.ack = ack and not legacy
+        self.legacy = legacy
+        self.rtt = LatencyStats()
+        self.last_ack = None  # (seq, round trip seconds, firmware micros) of the newest ACK
+        self.error = None     # Set when a background thread finds the connection broken
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._last = None
+        self._last_sent = time.monotonic()
+        self._alive = self._last_sent  # Last send() call, i.e. the control loop is making progress
+        self._sent_at = {}  # seq -> monotonic send time of frames waiting for their ACK
+        self._closed = threading.Event()
+
+        # Counters
+        self.sent = 0
+        self.heartbeats = 0
+        self.acks = 0
+        self.stalls = 0  # Times the heartbeats stopped because send() was not called
+
+        self._threads = []
+        if not legacy and heartbeat:
+            self._start(self._heartbeat, heartbeat)
+        if self.ack:
+            self._start(self._read_acks)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _send_frame(self, msg_type, code=0, steering=0, throttle=None):
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFF
+            self._last_sent = time.monotonic()
+            if self.ack:
+                if len(self._sent_at) > 1024:
+                    self._sent_at.clear()  # ACKs are not coming back
+                self._sent_at[self._seq] = self._last_sent
+            self.sock.sendall(encode(msg_type, self._seq, code, steering, throttle, self.ack))
+
+    def send(self, code, value, throttle=None, force=False):
+        """Send a command unless it repeats the previous one; returns whether it was sent."""
+        self._alive = time.monotonic()
+        value = max(-100, min(100, value))
+        if not force and (code, value, throttle) == self._last:
+            return False
+        self._last = (code, value, throttle)
+        if self.legacy:
+            with self._lock:
+                self.sock.sendall(LEGACY.pack(code, value))
+        else:
+            self._send_frame(COMMAND, code, value, throttle)
+        self.sent += 1
+        return True
+
+    def _heartbeat(self, interval):
+        stalled = False
+        while not self._closed.wait(interval / 2):
+            now = time.monotonic()
+            if now - self._alive > WATCHDOG:
+                # Hung control loop: let the watchdog stop the car, and resend the
+                # next command even if it repeats the one from before the stop
+                if not stalled:
+                    stalled = True
+                    self.stalls += 1
+                self._last = None
+                continue
+            stalled = False
+            if now - self._last_sent >= interval:
+                try:
+                    self._send_frame(HEARTBEAT, *(self._last or (CMD_STOP, 0, None)))
+                except OSError as e:
+                    self.error = e
+                    return
+                self.heartbeats += 1
+
+    def _read_acks(self):
+        stream = self.sock.makefile('rb')
+        while not self._closed.is_set():
+            try:
+                data = stream.read(ACK_SIZE)
+            except (OSError, ValueError) as e:
+                self.error = self.error or e
+                return
+            if len(data) < ACK_SIZE:
+                if not self._closed.is_set():
+                    self.error = self.error or ConnectionResetError("Connection closed by the car")
+                return
+            ack = decode_ack(data)
+            if ack is None:
+                continue
+            seq, stamp, device_micros = ack
+            sent_at = self._sent_at.pop(seq, None)
+            if sent_at is None:
+                continue
+            rtt = time.monotonic() - sent_at
+            self.rtt.add(rtt)
+            self.last_ack = (seq, rtt, device_micros)
+            self.acks += 1
+
+    def close(self):
+        """Stop the motors and close the connection."""
+        if self._closed.is_set():
+            return
+        try:
+            self.send(CMD_STOP, 0, force=True)
+        except OSError:
+            pass
+        self._closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def stats(self):
+        return {'sent': self.sent, 'heartbeats': self.heartbeats, 'acks': self.acks, 'stalls': self.stalls,
+                'rtt': self.rtt.summary() if self.ack else None}
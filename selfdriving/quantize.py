@@ -0,0 +1,128 @@
+"""Export quantized TFLite variants of the steering model and compare them.
+
+    python -m selfdriving.quantize --model new_non_golay_model_2.h5 \\
+        --data "12 Laps perfected new/forward_images" --out quantized
+
+writes model_float32.tflite, model_float16.tflite and model_int8.tflite
+plus report.json. The int8 variant is calibrated on a random sample of
+the recorded frames; a separate sample is used to measure how far each
+variant's steering drifts from the float Keras model and how long one
+frame takes. Any of the files can be passed to the deployment script
+with --model.
+"""
+import argparse
+import json
+import os
+import random
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples
+from selfdriving.inference import INPUT_SHAPE, KerasEngine, TFLiteEngine
+from selfdriving.preprocess import Preprocessor
+
+VARIANTS = ('float32', 'float16', 'int8')
+
+
+def load_frames(samples):
+    """Preprocess recorded frames into a (N, 66, 200, 3) float32 array plus steering labels."""
+    preprocess = Preprocessor(flip=None)  # Recorded frames are already flipped
+    frames = np.empty((len(samples),) + INPUT_SHAPE[1:], np.float32)
+    labels = np.empty(len(samples), np.float32)
+    for i, sample in enumerate(samples):
+        frames[i] = preprocess(cv2.imread(sample.path))[0]
+        labels[i] = sample.steering / 100
+    return frames, labels
+
+
+def convert(model, variant, calibration=None):
+    """Convert a Keras model to TFLite bytes. Inputs and outputs stay float32 for every variant."""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        def representative_dataset():
+            for frame in calibration:
+                yield [frame[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif variant != 'float32':
+        raise ValueError(f"Unknown variant {variant!r}")
+    return converter.convert()
+
+
+def evaluate(engine, frames, labels, reference):
+    """Steering error and latency of one engine on the evaluation frames."""
+    predictions = np.array([engine.predict(frame[np.newaxis]) for frame in frames])
+    latency = engine.latency.percentiles(50, 99)
+    return {
+        'mse_vs_float': float(np.mean((predictions - reference) ** 2)),
+        'mse_vs_labels': float(np.mean((predictions - labels) ** 2)),
+        'max_abs_diff': float(np.max(np.abs(predictions - reference))),
+        'latency_p50_ms': latency['p50'],
+        'latency_p99_ms': latency['p99'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export float16/int8 TFLite steering models and compare them.")
+    parser.add_argument('--model', default='new_non_golay_model_2.h5', help="Keras .h5 weights")
+    parser.add_argument('--data', nargs='+', required=True, help="Folders of recorded {counter}_{steering}_{timestamp}.jpg frames")
+    parser.add_argument('--out', default='quantized', help="Output folder")
+    parser.add_argument('--calibration', type=int, default=200, help="Frames used to calibrate int8")
+    parser.add_argument('--eval', type=int, default=500, help="Frames used for the report")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    samples = [s for folder in args.data for s in list_samples(folder)]
+    if not samples:
+        parser.error("No recorded frames found")
+    random.Random(args.seed).shuffle(samples)
+    calibration, _ = load_frames(samples[:args.calibration])
+    eval_samples = samples[args.calibration:args.calibration + args.eval] or samples[:args.eval]
+    frames, labels = load_frames(eval_samples)
+    print(f"[INFO] {len(calibration)} calibration frames, {len(frames)} evaluation frames")
+
+    keras_engine = KerasEngine(args.model)
+    keras_engine.predict(frames[:1])  # Trace before timing
+    keras_engine.latency.reset()
+    reference = np.array([keras_engine.predict(frame[np.newaxis]) for frame in frames])
+    latency = keras_engine.latency.percentiles(50, 99)
+    report = {'keras': {
+        'path': args.model,
+        'size_bytes': os.path.getsize(args.model),
+        'mse_vs_float': 0.0,
+        'mse_vs_labels': float(np.mean((reference - labels) ** 2)),
+        'max_abs_diff': 0.0,
+        'latency_p50_ms': latency['p50'],
+        'latency_p99_ms': latency['p99'],
+    }}
+
+    os.makedirs(args.out, exist_ok=True)
+    for variant in VARIANTS:
+        path = os.path.join(args.out, f'model_{variant}.tflite')
+        with open(path, 'wb') as f:
+            f.write(convert(keras_engine.model, variant, calibration))
+        engine = TFLiteEngine(path)
+        engine.predict(frames[:1])
+        engine.latency.reset()
+        report[variant] = {'path': path, 'size_bytes': os.path.getsize(path), **evaluate(engine, frames, labels, reference)}
+
+    with open(os.path.join(args.out, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'variant':<10}{'size KB':>10}{'MSE vs float':>15}{'MSE vs label':>15}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, row in report.items():
+        print(f"{name:<10}{row['size_bytes'] / 1024:>10.0f}{row['mse_vs_float']:>15.6f}"
+              f"{row['mse_vs_labels']:>15.6f}{row['latency_p50_ms']:>9.2f}{row['latency_p99_ms']:>9.2f}")
+    print(f"[OK] Report saved to {os.path.join(args.out, 'report.json')}")
+
+
+if __name__ == "__main__":
+    main()
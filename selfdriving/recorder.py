@@ -0,0 +1,119 @@
+import os
+import queue
+import threading
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import format_filename
+
+
+class FolderSink:
+    """Writes every frame to its own ``{counter}_{steering}_{timestamp}.jpg`` file."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, seq, steering, timestamp, jpeg):
+        with open(os.path.join(self.folder, format_filename(seq, steering, timestamp)), 'wb') as f:
+            f.write(jpeg)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FrameWriter:
+    """Saves recorded frames on a background thread so the control loop never waits on disk.
+
+    ``submit()`` only queues the frame and returns immediately. JPEG bytes
+    (e.g. straight from the stream) are stored as they are; images are
+    JPEG-encoded on the writer thread. Each stream sequence number is saved
+    at most once, and when the bounded queue is full the frame is dropped
+    and counted rather than blocking the caller.
+
+    ``sink`` is a folder path (one JPEG file per frame, see FolderSink) or
+    any object with ``write(seq, steering, timestamp, jpeg)``, ``flush()``
+    and ``close()``, such as ``selfdriving.shards.ShardWriter``.
+    """
+
+    def __init__(self, sink, max_queue=64, batch_size=16):
+        self.sink = FolderSink(sink) if isinstance(sink, str) else sink
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._last_seq = 0
+
+        # Counters
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._thread = threading.Thread(target=self._run, name='FrameWriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, seq, steering, data):
+        """Queue frame ``seq`` with its steering label; returns False if it was skipped or dropped.
+
+        ``data`` is either JPEG bytes or a BGR image. Images are copied, so
+        the caller may reuse the buffer right away.
+        """
+        if seq <= self._last_seq:
+            return False  # Already saved this camera frame
+        self._last_seq = seq
+        if isinstance(data, np.ndarray):
+            data = data.copy()
+        try:
+            self._queue.put_nowait((seq, steering, datetime.now(), data))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def _write(self, seq, steering, timestamp, data):
+        if isinstance(data, np.ndarray):
+            ok, encoded = cv2.imencode('.jpg', data)
+            if not ok:
+                raise OSError(f"Could not encode frame {seq}")
+            data = encoded.tobytes()
+        self.sink.write(seq, steering, timestamp, data)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Drain whatever else is waiting so a burst is handled in one go
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    self.sink.close()
+                    return
+                try:
+                    self._write(*item)
+                    self.written += 1
+                except OSError as e:
+                    self.errors += 1
+                    print("[ERROR] Could not save frame:", e)
+            self.sink.flush()
+
+    def close(self, timeout=5):
+        """Write out everything still queued, close the sink and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
@@ -0,0 +1,251 @@
+"""Host-side MJPEG relay: one connection to the car, any number of local consumers.
+
+The ESP32 serves ``/stream`` to one client at a time from a single frame
+buffer, so a second ``requests.get(STREAM_URL)`` from the recorder or a
+viewer slows the camera down for the autopilot. The relay holds the only
+upstream connection, cuts every JPEG out of the stream once and hands
+the same bytes to every subscriber:
+
+    python -m selfdriving.relay --source http://192.168.4.1:81/stream --port 8090
+
+and point the scripts at ``http://127.0.0.1:8090/stream`` (append
+``?fps=5`` to limit a viewer's rate). In the same process, subscribe
+directly and skip HTTP altogether:
+
+    relay = MJPEGRelay(car.stream_url, port=8090).start()
+    camera = FrameSource(relay.subscribe())        # Autopilot, full rate
+    viewer = relay.subscribe(max_fps=5, maxlen=2)  # Anyone else
+
+Every subscriber has its own small drop-oldest queue and optional rate
+limit. Publishing a frame only appends a reference to each queue, so a
+slow subscriber loses frames but never delays the others, and more
+subscribers cost no upstream bandwidth.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from selfdriving.car import ESP32_IP, STREAM_PORT, Backoff, stream_frames
+
+RELAY_PORT = 8090
+BOUNDARY = 'frame'  # Same part format as the firmware's stream_handler
+
+# seq: relay sequence number, received: time.monotonic() when the JPEG arrived from the car
+RelayFrame = namedtuple('RelayFrame', 'seq received jpeg')
+
+
+class Subscription:
+    """One consumer's view of the relay: a drop-oldest queue of at most ``maxlen`` frames.
+
+    With ``max_fps`` frames that arrive sooner than 1/max_fps after the
+    last accepted one are skipped (10% jitter allowed). ``get`` returns the
+    oldest queued RelayFrame, so ``maxlen=1`` always gives the newest one.
+    """
+
+    def __init__(self, max_fps=None, maxlen=1, name=None):
+        self.max_fps = max_fps
+        self.name = name
+        self._interval = 0.9 / max_fps if max_fps else 0.0
+        self._next = 0.0
+        self._queue = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Counters
+        self.offered = 0
+        self.skipped = 0    # Rate limited
+        self.dropped = 0    # Pushed out of a full queue before they were taken
+        self.delivered = 0
+
+    def _offer(self, frame):
+        self.offered += 1
+        if frame.received < self._next:
+            self.skipped += 1
+            return
+        self._next = frame.received + self._interval
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(frame)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """The next queued RelayFrame, waiting up to ``timeout`` seconds; None on timeout or when closed."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue or self._closed, timeout) or not self._queue:
+                return None
+            self.delivered += 1
+            return self._queue.popleft()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        return {'name': self.name, 'max_fps': self.max_fps, 'offered': self.offered, 'skipped': self.skipped,
+                'dropped': self.dropped, 'delivered': self.delivered}
+
+
+class MJPEGRelay:
+    """Reads the car's stream on a thread and publishes every frame to the subscriptions.
+
+    With a ``port`` the frames are also served as
+    ``multipart/x-mixed-replace`` on http://host:port/stream (one
+    subscription per client, ``?fps=N`` to rate limit it) and the counters
+    as JSON on /stats.
+    """
+
+    def __init__(self, url, host='127.0.0.1', port=RELAY_PORT, chunk_size=4096, backoff=None, verbose=True):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.backoff = backoff or Backoff()
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.seq = 0
+        self.bytes = 0
+        self.connects = 0
+
+        self._server = None
+        if port is not None:
+            relay = self
+
+            class StreamHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    url = urlparse(self.path)
+                    if url.path == '/stats':
+                        body = json.dumps(relay.stats()).encode()
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/json')
+                        self.send_header('Content-Length', str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                        return
+                    if url.path != '/stream':
+                        self.send_error(404)
+                        return
+                    fps = parse_qs(url.query).get('fps')
+                    try:
+                        max_fps = float(fps[0]) if fps else None
+                    except ValueError:
+                        max_fps = 0.0
+                    if max_fps is not None and not max_fps > 0:  # Also rejects nan
+                        self.send_error(400, "fps must be a number > 0")
+                        return
+                    subscription = relay.subscribe(max_fps,
+                                                   name=f"http {self.client_address[0]}:{self.client_address[1]}")
+                    self.send_response(200)
+                    self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+                    self.end_headers()
+                    try:
+                        relay._serve(subscription, self.wfile)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    finally:
+                        relay.unsubscribe(subscription)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((host, port), StreamHandler)
+            self._server.daemon_threads = True
+
+    @property
+    def relay_url(self):
+        if self._server is None:
+            return None
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/stream"
+
+    def subscribe(self, max_fps=None, maxlen=1, name=None):
+        """A new Subscription that receives every frame from now on."""
+        subscription = Subscription(max_fps, maxlen, name)
+        with self._lock:
+            # Copy on write: the reader thread iterates its own snapshot without locking
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s is not subscription]
+        subscription.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='relay', daemon=True)
+        self._thread.start()
+        if self._server is not None:
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def _connected(self):
+        self.connects += 1
+
+    def _run(self):
+        for received, jpg in stream_frames(self.url, self._stop, self.backoff, self.chunk_size,
+                                           on_connect=self._connected, verbose=self.verbose):
+            self.seq += 1
+            frame = RelayFrame(self.seq, received, bytes(jpg))  # The only copy, shared by every subscriber
+            self.bytes += len(frame.jpeg)
+            for subscription in self._subscriptions:
+                subscription._offer(frame)
+
+    def _serve(self, subscription, out):
+        while not self._stop.is_set():
+            frame = subscription.get(timeout=1)
+            if frame is None:
+                continue
+            out.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame.jpeg)}\r\n\r\n".encode())
+            out.write(frame.jpeg)
+            out.write(b"\r\n")
+            out.flush()
+
+    def stop(self):
+        self._stop.set()
+        for subscription in self._subscriptions:
+            subscription.close()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def stats(self):
+        return {'frames': self.seq, 'bytes': self.bytes, 'connects': self.connects,
+                'subscriptions': [s.stats() for s in self._subscriptions]}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay the car's camera stream to any number of local clients.")
+    parser.add_argument('--source', default=f"http://{ESP32_IP}:{STREAM_PORT}/stream", help="Stream URL of the car")
+    parser.add_argument('--host', default='127.0.0.1', help="0.0.0.0 to serve other machines too")
+    parser.add_argument('--port', type=int, default=RELAY_PORT)
+    args = parser.parse_args()
+
+    relay = MJPEGRelay(args.source, args.host, args.port)
+    print(f"[OK] Relaying {args.source} on {relay.relay_url} (?fps=N to rate limit a client). Ctrl+C to stop.")
+    with relay:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print("[INFO]", relay.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Review videos of recorded drives, optionally with the model's predictions.
+
+    python -m selfdriving.render "12 Laps perfected new/backward_images" --out backward_video.avi
+    python -m selfdriving.render "12 Laps perfected new/backward_images" --out comparison.avi \
+        --model new_non_golay_model_2.h5
+
+Frames are handled in chunks that flow through a small pipeline:
+
+    decode + preprocess (thread pool) -> predict whole chunk -> draw overlays (thread pool) -> write
+
+Chunks are written strictly in order, and only ``prefetch`` chunks are in
+flight at each pool stage, so memory stays bounded however long the drive
+is. Every frame shows the recorded steering, the prediction if a model is
+given, and a steering bar at the bottom.
+"""
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples, parse_filename
+from selfdriving.preprocess import preprocess_uint8
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+TRUE_COLOR = (0, 255, 255)  # Yellow
+PRED_COLOR = (255, 0, 0)    # Blue
+BAR_HEIGHT = 12
+
+
+def draw_overlay(frame, true_angle=None, predicted_angle=None):
+    """Draw steering text and a steering bar (-100 left .. 100 right) on a BGR frame in place."""
+    height, width = frame.shape[:2]
+    scale = width / 640  # Text sized for 640 px wide frames
+    thickness = max(1, round(2 * scale))
+    line = round(30 * scale)
+    if true_angle is not None:
+        cv2.putText(frame, f"True Angle: {true_angle}", (10, line), FONT, scale, TRUE_COLOR, thickness)
+    if predicted_angle is not None:
+        cv2.putText(frame, f"Predicted: {predicted_angle}", (10, 2 * line), FONT, scale, PRED_COLOR, thickness)
+
+    # Steering bar: grey track, white center line, a marker per angle
+    top = height - BAR_HEIGHT - 4
+    cv2.rectangle(frame, (10, top), (width - 10, top + BAR_HEIGHT), (80, 80, 80), -1)
+    center = width // 2
+    cv2.line(frame, (center, top), (center, top + BAR_HEIGHT), (255, 255, 255), 1)
+    for angle, color in ((true_angle, TRUE_COLOR), (predicted_angle, PRED_COLOR)):
+        if angle is not None:
+            x = center + int(np.clip(angle, -100, 100) / 100 * (center - 10))
+            cv2.rectangle(frame, (x - 3, top - 2), (x + 3, top + BAR_HEIGHT + 2), color, -1)
+    return frame
+
+
+def _load_chunk(start, paths, with_inputs):
+    frames = [cv2.imread(p) for p in paths]
+    ok = [i for i, frame in enumerate(frames) if frame is not None]
+    frames = [frames[i] for i in ok]
+    inputs = np.stack([preprocess_uint8(frame) for frame in frames]) if with_inputs and frames else None
+    return [start + i for i in ok], frames, inputs
+
+
+def _compose_chunk(frames, true_angles, predicted_angles, size):
+    for i, frame in enumerate(frames):
+        if (frame.shape[1], frame.shape[0]) != size:
+            frames[i] = frame = cv2.resize(frame, size)
+        draw_overlay(frame, true_angles[i], None if predicted_angles is None else predicted_angles[i])
+    return frames
+
+
+def _in_order(pool, fn, jobs, prefetch):
+    # Run fn(*job) on the pool with at most ``prefetch`` jobs ahead; yield results in job order
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(fn, *job))
+        if len(pending) > prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def render(image_paths, output, engine=None, fps=24.0, fourcc='XVID', workers=None, chunk_size=256, prefetch=2):
+    """Write a review video of ``image_paths`` (in the given order); returns the number of frames.
+
+    The true angle comes from the recorder filename. With an inference
+    ``engine`` (see ``selfdriving.inference.load_engine``) every frame is
+    also run through the model, a chunk at a time.
+    """
+    image_paths = [str(p) for p in image_paths]
+    true_angles = []
+    for path in image_paths:
+        parsed = parse_filename(path)
+        true_angles.append(None if parsed is None else parsed[1])
+
+    size = None
+
+    def predicted(chunks):
+        # Runs on the calling thread, between the two pool stages
+        nonlocal size
+        for positions, frames, inputs in chunks:
+            if not frames:
+                continue
+            if size is None:
+                size = (frames[0].shape[1], frames[0].shape[0])
+            angles = None
+            if engine is not None:
+                inputs = np.multiply(inputs, np.float32(1 / 255.0), dtype=np.float32)
+                angles = np.rint(engine.predict_batch(inputs) * 100).astype(int).tolist()
+            yield frames, [true_angles[i] for i in positions], angles, size
+
+    start_time = time.perf_counter()
+    video = None
+    written = 0
+    with ThreadPoolExecutor(workers) as pool:
+        jobs = ((start, image_paths[start:start + chunk_size], engine is not None)
+                for start in range(0, len(image_paths), chunk_size))
+        decoded = _in_order(pool, _load_chunk, jobs, prefetch)
+        for frames in _in_order(pool, _compose_chunk, predicted(decoded), prefetch):
+            if video is None:
+                video = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+                if not video.isOpened():
+                    raise OSError(f"Could not open {output} for writing")
+            for frame in frames:
+                video.write(frame)
+            written += len(frames)
+
+    if video is not None:
+        video.release()
+    elapsed = time.perf_counter() - start_time
+    print(f"[OK] Wrote {written} frames to {output} in {elapsed:.1f} s ({written / max(elapsed, 1e-9):.0f} frames/s)")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a review video of a recorded drive.")
+    parser.add_argument('folder', help="Folder of {counter}_{steering}_{timestamp}.jpg frames")
+    parser.add_argument('--out', required=True, help="Output video, e.g. drive.avi")
+    parser.add_argument('--model', help="Model to overlay predictions from (.h5 or .tflite)")
+    parser.add_argument('--backend', default='auto', help="Inference backend, see selfdriving.inference")
+    parser.add_argument('--fps', type=float, default=24.0)
+    parser.add_argument('--fourcc', default='XVID')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    engine = None
+    if args.model:
+        from selfdriving.inference import load_engine
+        engine = load_engine(args.model, args.backend)
+    paths = [s.path for s in list_samples(args.folder)]
+    if not paths:
+        parser.error(f"no recorded frames in {args.folder}")
+    render(paths, args.out, engine, args.fps, args.fourcc, args.workers)
+
+
+if __name__ == "__main__":
+    main()
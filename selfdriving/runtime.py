@@ -0,0 +1,235 @@
+"""Building blocks for running the driving loop as a pipeline of threads.
+
+Each stage (preprocess, infer, actuate, ...) runs on its own thread and
+always works on the newest output of the stage before it. Stages are
+connected by LatestValue slots, which hold a single item: a producer
+never waits for a slow consumer, it just replaces the item, and a
+consumer never works on anything but the newest one. A slow stage
+therefore only lowers its own rate and never queues up stale work for
+the stages after it.
+
+    predictions = LatestValue()
+    Stage('infer', preprocessed.get, lambda job: job.next(engine.predict(job.data)), predictions.put).start()
+
+Newest-only hand-off bounds how stale a command can get, but not below
+the time the stages take. LoadShedder watches the age of the commands
+and steps through cheaper ways of running the loop when they get too
+old.
+"""
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+
+class LatestValue:
+    """Single-slot hand-off between threads: ``put`` replaces, ``get`` waits for something newer.
+
+    Items are passed by reference, so a producer must not modify an item
+    after putting it. Any number of consumers may read the same slot.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value = None
+        self._seq = 0
+        self._taken = 0
+        self._closed = False
+
+        # Counters
+        self.produced = 0
+        self.dropped = 0
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def put(self, value):
+        """Store ``value`` as the newest item; returns its sequence number."""
+        with self._cond:
+            if self._seq > self._taken:
+                self.dropped += 1  # The previous item was never picked up
+            self._value = value
+            self._seq += 1
+            self.produced += 1
+            self._cond.notify_all()
+            return self._seq
+
+    def get(self, after=0, timeout=None):
+        """``(seq, item)`` of the newest item with a sequence number above ``after``.
+
+        Waits up to ``timeout`` seconds (forever if None); returns None on
+        timeout or once the slot is closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after or self._closed, timeout):
+                return None
+            if self._seq <= after:
+                return None
+            self._taken = self._seq
+            return self._seq, self._value
+
+    def close(self):
+        """Wake up all waiting consumers for good."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Job(namedtuple('Job', 'seq stamps data')):
+    """One camera frame on its way through the stages.
+
+    ``stamps`` collects a monotonic timestamp per stage; ``next`` returns
+    the job for the following stage with the current time appended.
+    """
+
+    def next(self, data):
+        return Job(self.seq, self.stamps + (time.monotonic(),), data)
+
+
+class Stage:
+    """Runs ``work(item)`` on a thread for every new item from ``get`` and passes results to ``put``.
+
+    ``get(after, timeout)`` returns ``(seq, item)`` or None, like
+    ``LatestValue.get``. ``work`` returns the item for the next stage, or
+    None to pass nothing on. Exceptions in ``work`` are counted and printed
+    and the stage carries on with the next item.
+    """
+
+    def __init__(self, name, get, work, put=None):
+        self.name = name
+        self._get = get
+        self._work = work
+        self._put = put
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+        # Counters
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0  # Seconds spent in work()
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        last = 0
+        while not self._stop.is_set():
+            got = self._get(last, 0.1)
+            if got is None:
+                continue
+            last, item = got
+            start = time.monotonic()
+            try:
+                result = self._work(item)
+            except Exception as e:
+                self.errors += 1
+                print(f"[ERROR] {self.name} stage: {e}")
+                continue
+            finally:
+                self.busy += time.monotonic() - start
+            self.processed += 1
+            if result is not None and self._put is not None:
+                self._put(result)
+
+    def stop(self, timeout=1):
+        self._stop.set()
+        if self._started is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started else 0
+        return {
+            'processed': self.processed,
+            'errors': self.errors,
+            'rate': self.processed / elapsed if elapsed else None,
+            'busy': self.busy / elapsed if elapsed else None,  # Fraction of the time spent working
+        }
+
+
+# name: shown in the log; enter/leave: called without arguments to switch the level on and off
+Level = namedtuple('Level', 'name enter leave')
+
+
+class LoadShedder:
+    """Keeps the frame age of the steering commands below ``max_age`` by degrading in steps.
+
+    ``levels`` are Levels from cheapest to most drastic. The actuating
+    thread reports the age of every command (command time minus frame
+    arrival) with ``observe``; ``update`` is called periodically from one
+    thread and compares the p95 age over the last ``window`` commands with
+    the bound. Above ``shed_at`` x max_age the next level is entered at
+    once; the last one is left again only after the p95 has stayed below
+    ``recover_at`` x max_age for ``recover_after`` seconds. After every
+    transition the window is cleared and nothing changes for ``settle``
+    seconds, so each decision is based on the new level's ages only.
+    """
+
+    def __init__(self, levels, max_age, window=30, shed_at=0.8, recover_at=0.4, settle=1.0, recover_after=3.0,
+                 verbose=True):
+        self.levels = list(levels)
+        self.max_age = max_age
+        self.shed_at = shed_at
+        self.recover_at = recover_at
+        self.settle = settle
+        self.recover_after = recover_after
+        self.verbose = verbose
+        self.level = 0  # Number of levels entered
+        self.transitions = []  # (monotonic time, new level, level name, p95 age in seconds)
+        self._ages = deque(maxlen=window)
+        self._settled = 0.0
+        self._calm_since = None
+
+        # Counters
+        self.commands = 0
+        self.stale = 0  # Commands older than max_age
+
+    @property
+    def name(self):
+        return self.levels[self.level - 1].name if self.level else 'normal'
+
+    def observe(self, age):
+        self._ages.append(age)
+        self.commands += 1
+        if age > self.max_age:
+            self.stale += 1
+
+    def update(self, now=None):
+        """Enter or leave a level if the ages call for it; returns the p95 age, or None if still settling."""
+        now = time.monotonic() if now is None else now
+        if now < self._settled or len(self._ages) < self._ages.maxlen // 2:
+            return None
+        p95 = float(np.percentile(self._ages, 95))
+        if p95 > self.shed_at * self.max_age:
+            self._calm_since = None
+            if self.level < len(self.levels):
+                self.levels[self.level].enter()
+                self.level += 1
+                self._transition(now, p95, f"Falling behind, entered level {self.level} ({self.name})")
+        elif p95 < self.recover_at * self.max_age and self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.recover_after:
+                self.level -= 1
+                self.levels[self.level].leave()
+                self._transition(now, p95, f"Caught up, left level {self.level + 1} ({self.levels[self.level].name})")
+        else:
+            self._calm_since = None
+        return p95
+
+    def _transition(self, now, p95, what):
+        self.transitions.append((now, self.level, self.name, p95))
+        if self.verbose:
+            print(f"[SHED] {what}: command age p95 {p95 * 1000:.0f} ms, "
+                  f"bound {self.max_age * 1000:.0f} ms")
+        self._ages.clear()
+        self._settled = now + self.settle
+        self._calm_since = None
+
+    def stats(self):
+        return {'level': self.level, 'name': self.name, 'commands': self.commands, 'stale': self.stale,
+                'transitions': len(self.transitions)}
@@ -0,0 +1,424 @@
+"""Shared inference server: one model for many cars, with dynamic micro-batching.
+
+    python -m selfdriving.serving serve --model new_non_golay_model_2.h5
+    python 8_self_driving_model_deployment.py --server /tmp/selfdriving-inference.sock ...   # once per car
+    python -m selfdriving.serving bench --frames "12 Laps perfected new/forward_images" --cars 4
+
+The server loads the model once and listens on a Unix socket (or
+``host:port`` for TCP, e.g. on Windows). Each client sends preprocessed
+66x200x3 frames, as the float32 model input or the 8-bit YUV image
+(``Preprocessor.small``, a quarter of the bytes; the server scales it
+exactly like the Preprocessor does). Requests from all connections go
+into one queue. The batcher takes the first waiting request and keeps
+collecting until it has ``max_batch`` frames or ``max_delay`` has
+passed since that first request arrived, runs them as one
+``predict_batch`` call and sends every client its own steering value.
+
+Wire format, big-endian: request = ``>IB`` (request id, dtype: 0 float32,
+1 uint8) followed by the frame bytes; reply = ``>If`` (request id,
+normalized steering angle). Replies on a connection come back in request
+order, so a client may pipeline several requests (see
+``RemoteEngine.predict_batch``).
+
+``bench`` replays recorded frames from several simulated cars at a set
+rate and reports per-car latency and the total throughput.
+"""
+import argparse
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples
+from selfdriving.inference import BACKENDS, INPUT_SHAPE, InferenceEngine, LatencyStats, load_engine
+from selfdriving.preprocess import Preprocessor
+
+ADDRESS = '/tmp/selfdriving-inference.sock'
+MAX_BATCH = 16
+MAX_DELAY = 0.003  # Seconds the first request of a batch may wait for others
+
+REQUEST = struct.Struct('>IB')
+REPLY = struct.Struct('>If')
+DTYPES = {0: np.dtype(np.float32), 1: np.dtype(np.uint8)}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+FRAME_SHAPE = INPUT_SHAPE[1:]
+
+# conn: the client's _Connection, arrived: time.monotonic() when the frame was read
+Request = namedtuple('Request', 'conn id frame arrived')
+
+
+def parse_address(address):
+    """``(family, address)`` for a Unix socket path or a ``host:port`` string."""
+    host, sep, port = str(address).rpartition(':')
+    if sep and port.isdigit() and '/' not in host:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, str(address)
+
+
+def recv_into(sock, buffer):
+    """Fill ``buffer`` completely from ``sock``; raises ConnectionError when the peer closes."""
+    view = memoryview(buffer).cast('B')
+    while len(view):
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError("Connection closed")
+        view = view[n:]
+
+
+class _Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def reply(self, request_id, steering):
+        with self.lock:
+            self.sock.sendall(REPLY.pack(request_id, steering))
+
+    def close(self):
+        # Shutdown wakes up the reader thread, which closes the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class InferenceServer:
+    """Serves ``engine`` to any number of clients, batching their frames together."""
+
+    def __init__(self, engine, address=ADDRESS, max_batch=MAX_BATCH, max_delay=MAX_DELAY, verbose=True):
+        self.engine = engine
+        self.address = address
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.verbose = verbose
+        self._queue = queue.Queue()
+        self._batch = np.empty((max_batch,) + FRAME_SHAPE, np.float32)
+        self._stop = threading.Event()
+        self._sock = None
+        self._threads = []
+
+        # Counters
+        self.clients = 0
+        self.frames = 0
+        self.batches = 0
+        self.errors = 0  # Batches that predict_batch failed on
+        self.batch_sizes = np.zeros(max_batch + 1, np.int64)
+        self.wait = LatencyStats()   # Arrival to start of the batch
+        self.run = LatencyStats()    # predict_batch time per batch
+
+    def start(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)  # Left over from a server that did not shut down cleanly
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self._sock.listen()
+        for target in (self._accept, self._batcher):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients += 1
+            threading.Thread(target=self._serve_client, args=(_Connection(sock),), daemon=True).start()
+
+    def _serve_client(self, conn):
+        header = bytearray(REQUEST.size)
+        try:
+            while not self._stop.is_set():
+                recv_into(conn.sock, header)
+                request_id, code = REQUEST.unpack(header)
+                frame = np.empty(FRAME_SHAPE, DTYPES[code])
+                recv_into(conn.sock, frame)
+                self._queue.put(Request(conn, request_id, frame, time.monotonic()))
+        except (ConnectionError, OSError, KeyError):
+            pass
+        finally:
+            conn.sock.close()
+
+    def _collect(self):
+        """The next batch of requests: at most max_batch, waiting at most max_delay after the first."""
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.arrived + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _batcher(self):
+        scale = np.float32(1 / 255.0)  # Same scaling as Preprocessor
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            start = time.monotonic()
+            images = self._batch[:len(batch)]
+            for slot, request in zip(images, batch):
+                if request.frame.dtype == np.uint8:
+                    np.multiply(request.frame, scale, out=slot)
+                else:
+                    slot[...] = request.frame
+                self.wait.add(start - request.arrived)
+            try:
+                steering = self.engine.predict_batch(images)
+            except Exception as e:
+                # There is no error reply: close the connections so their clients fail now instead of timing out
+                self.errors += 1
+                print(f"[ERROR] Inference on a batch of {len(batch)} failed: {e!r}")
+                for request in batch:
+                    request.conn.close()
+                continue
+            self.run.add(time.monotonic() - start)
+            for request, value in zip(batch, steering):
+                try:
+                    request.conn.reply(request.id, float(value))
+                except OSError:
+                    pass  # Client went away, its reader thread cleans up
+            self.frames += len(batch)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            family, address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+    def stats(self):
+        return {
+            'clients': self.clients,
+            'frames': self.frames,
+            'batches': self.batches,
+            'errors': self.errors,
+            'mean_batch': self.frames / self.batches if self.batches else None,
+            'batch_sizes': {int(n): int(c) for n, c in enumerate(self.batch_sizes) if c},
+            'wait': self.wait.summary(),
+            'run': self.run.summary(),
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class RemoteEngine(InferenceEngine):
+    """InferenceEngine that runs on an InferenceServer; ``latency`` includes the round trip.
+
+    ``predict`` takes the float32 model input or the uint8 8-bit YUV image
+    (``Preprocessor.small``) and sends it as is. A request that times out,
+    fails or gets a reply out of order raises, and the connection is
+    dropped so that no late reply can be mistaken for the next one; the
+    next request connects again. ``failures`` counts the requests that
+    failed in a row.
+    """
+
+    name = 'remote'
+
+    def __init__(self, address=ADDRESS, timeout=5):
+        super().__init__()
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self._id = 0
+        self._reply = bytearray(REPLY.size)
+
+        # Counters
+        self.connects = 0
+        self.failures = 0
+        self._connect()
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.connects += 1
+
+    def _request(self, fn, *args):
+        try:
+            if self.sock is None:
+                self._connect()
+            result = fn(*args)
+        except (OSError, RuntimeError):  # socket.timeout and ConnectionError are OSErrors
+            self.failures += 1
+            self.close()
+            raise
+        self.failures = 0
+        return result
+
+    def _send(self, frame):
+        frame = np.asarray(frame)
+        if frame.dtype not in DTYPE_CODES:
+            frame = frame.astype(np.float32)
+        frame = np.ascontiguousarray(frame.reshape(FRAME_SHAPE))
+        self._id = (self._id + 1) & 0xFFFFFFFF
+        self.sock.sendall(REQUEST.pack(self._id, DTYPE_CODES[frame.dtype]))
+        self.sock.sendall(frame)
+        return self._id
+
+    def _receive(self, request_id):
+        recv_into(self.sock, self._reply)
+        reply_id, steering = REPLY.unpack(self._reply)
+        if reply_id != request_id:
+            raise RuntimeError(f"Reply {reply_id} for request {request_id}")
+        return steering
+
+    def predict(self, batch):
+        start = time.perf_counter()
+        value = self._request(lambda: self._receive(self._send(batch)))
+        self.latency.add(time.perf_counter() - start)
+        return value
+
+    def predict_batch(self, images, window=32):
+        return self._request(self._pipelined, images, window)
+
+    def _pipelined(self, images, window):
+        # Keep up to ``window`` requests in flight so the server can batch them
+        ids = []
+        result = np.empty(len(images), np.float32)
+        done = 0
+        for image in images:
+            ids.append(self._send(image))
+            if len(ids) - done >= window:
+                result[done] = self._receive(ids[done])
+                done += 1
+        for i in range(done, len(ids)):
+            result[i] = self._receive(ids[i])
+        return result
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def load_frames(folder, limit=None):
+    """8-bit YUV model inputs (Preprocessor.small) of a recorded drive, as sent by the cars."""
+    preprocess = Preprocessor(flip=None)  # Recorded frames are already flipped
+    frames = []
+    for sample in list_samples(folder)[:limit]:
+        image = cv2.imread(sample.path)
+        if image is not None:
+            preprocess(image)
+            frames.append(preprocess.small.copy())
+    return frames
+
+
+def bench(address, frames, cars=4, fps=20.0, seconds=10.0):
+    """Replay ``frames`` from ``cars`` threads at ``fps`` each (0: as fast as possible) for ``seconds``.
+
+    Returns per-car round-trip percentiles and the total frames per second.
+    """
+    engines = [RemoteEngine(address) for _ in range(cars)]
+    stop = time.monotonic() + seconds
+
+    def drive(engine, offset):
+        period = 1 / fps if fps else 0
+        due = time.monotonic()
+        i = offset
+        while time.monotonic() < stop:
+            engine.predict(frames[i % len(frames)])
+            i += 1
+            if period:
+                due += period
+                time.sleep(max(0.0, due - time.monotonic()))
+
+    threads = [threading.Thread(target=drive, args=(engine, n * len(frames) // cars)) for n, engine in enumerate(engines)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    total = sum(engine.latency.count for engine in engines)
+    for engine in engines:
+        engine.close()
+    return {
+        'cars': [engine.latency.percentiles(50, 99) for engine in engines],
+        'frames': total,
+        'fps': total / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared batched inference server for several cars.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help="Load the model and serve it")
+    serve.add_argument('--model', required=True, help="Keras .h5 weights or a .tflite model")
+    serve.add_argument('--backend', default='auto', choices=['auto', *BACKENDS])
+    serve.add_argument('--address', default=ADDRESS, help="Unix socket path, or host:port for TCP")
+    serve.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    serve.add_argument('--max-delay', type=float, default=MAX_DELAY * 1000, help="Milliseconds")
+
+    bench_parser = commands.add_parser('bench', help="Replay recorded frames from several simulated cars")
+    bench_parser.add_argument('--frames', required=True, help="Recorder folder to replay")
+    bench_parser.add_argument('--address', default=ADDRESS)
+    bench_parser.add_argument('--cars', type=int, default=4)
+    bench_parser.add_argument('--fps', type=float, default=20.0, help="Per car, 0 for as fast as possible")
+    bench_parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        frames = load_frames(args.frames, limit=500)
+        result = bench(args.address, frames, args.cars, args.fps, args.seconds)
+        for n, p in enumerate(result['cars']):
+            print(f"car {n}: round trip p50 {p['p50']:.2f} ms, p99 {p['p99']:.2f} ms")
+        print(f"[INFO] {result['frames']} frames, {result['fps']:.0f} frames/s in total")
+        return
+
+    engine = load_engine(args.model, args.backend)
+    engine.warmup()
+    engine.predict_batch(np.zeros((args.max_batch,) + FRAME_SHAPE, np.float32))  # Warm up the batch path too
+    server = InferenceServer(engine, args.address, args.max_batch, args.max_delay / 1000)
+    with server:
+        print(f"[OK] Serving {args.model} ({engine.name} backend) on {args.address}, "
+              f"batches of up to {args.max_batch} within {args.max_delay:g} ms. Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print("[INFO]", server.stats())
+
+
+if __name__ == "__main__":
+    main()
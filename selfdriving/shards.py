@@ -0,0 +1,195 @@
+"""Packed, append-only storage for recorded drives.
+
+A dataset is a folder of shards. Each shard is two files that are only
+ever appended to:
+
+    shard-00000.bin   JPEG bytes, one frame after another
+    shard-00000.idx   one INDEX_DTYPE record per frame
+
+Both are memory-mapped when reading, so listing or filtering a drive only
+touches the small index, and reading a frame is a slice of the mapped
+.bin file instead of a file open.
+
+    python -m selfdriving.shards pack "tryout_backward_1" --out tryout_backward_1.shards
+    python -m selfdriving.shards info tryout_backward_1.shards
+"""
+import argparse
+import glob
+import os
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples, parse_timestamp
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),     # Byte offset of the JPEG in the .bin file
+    ('length', '<u4'),     # JPEG size in bytes
+    ('steering', '<i2'),   # -100..100, as in the recorder filenames
+    ('seq', '<u8'),        # Stream sequence number / image counter
+    ('timestamp', '<f8'),  # Seconds since the epoch, NaN if unknown
+])
+
+SHARD_SIZE = 256 << 20  # Start a new shard after 256 MB of JPEG data
+
+
+class ShardWriter:
+    """Appends JPEG frames to the shards in ``folder``.
+
+    Also works as a sink for ``FrameWriter``. Appending to an existing
+    dataset continues after its last shard.
+    """
+
+    def __init__(self, folder, shard_size=SHARD_SIZE):
+        self.folder = folder
+        self.shard_size = shard_size
+        os.makedirs(folder, exist_ok=True)
+        self._shard = len(glob.glob(os.path.join(folder, 'shard-*.idx')))
+        self._bin = self._idx = None
+        self._record = np.zeros(1, INDEX_DTYPE)
+        self.frames = 0
+
+    def _open_next(self):
+        self.close()
+        base = os.path.join(self.folder, f'shard-{self._shard:05d}')
+        self._shard += 1
+        self._bin = open(base + '.bin', 'ab')
+        self._idx = open(base + '.idx', 'ab')
+
+    def write(self, seq, steering, timestamp, jpeg):
+        """Append one JPEG. ``timestamp`` is a datetime, seconds since the epoch or None."""
+        if self._bin is None or self._bin.tell() >= self.shard_size:
+            self._open_next()
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        record = self._record[0]
+        record['offset'] = self._bin.tell()
+        record['length'] = len(jpeg)
+        record['steering'] = steering
+        record['seq'] = seq
+        record['timestamp'] = float('nan') if timestamp is None else timestamp
+        self._bin.write(jpeg)
+        self._idx.write(self._record.tobytes())
+        self.frames += 1
+
+    def flush(self):
+        # JPEG data first: a reader only trusts index records whose bytes are on disk
+        if self._bin is not None:
+            self._bin.flush()
+            self._idx.flush()
+
+    def close(self):
+        if self._bin is not None:
+            self.flush()
+            self._bin.close()
+            self._idx.close()
+            self._bin = self._idx = None
+
+
+class ShardDataset:
+    """Read-only, memory-mapped view of a shard folder.
+
+    ``index`` is a structured array with every INDEX_DTYPE field plus
+    ``shard``; filter it with NumPy and pass the positions to ``subset``.
+    """
+
+    def __init__(self, folder, _data=None, _index=None):
+        self.folder = folder
+        if _data is not None:
+            self._data, self.index = _data, _index
+            return
+
+        self._data = []
+        indices = []
+        for shard, idx_path in enumerate(sorted(glob.glob(os.path.join(folder, 'shard-*.idx')))):
+            bin_path = idx_path[:-4] + '.bin'
+            size = os.path.getsize(bin_path)
+            data = np.memmap(bin_path, np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+            raw = np.fromfile(idx_path, np.uint8)
+            index = raw[:len(raw) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+            # Drop records whose JPEG did not make it to disk (interrupted recording)
+            index = index[index['offset'] + index['length'] <= size]
+            self._data.append(data)
+            indices.append((shard, index))
+
+        dtype = np.dtype(INDEX_DTYPE.descr + [('shard', '<u2')])
+        self.index = np.zeros(sum(len(i) for _, i in indices), dtype)
+        start = 0
+        for shard, index in indices:
+            part = self.index[start:start + len(index)]
+            for name in INDEX_DTYPE.names:
+                part[name] = index[name]
+            part['shard'] = shard
+            start += len(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def steering(self):
+        return self.index['steering']
+
+    @property
+    def seq(self):
+        return self.index['seq']
+
+    @property
+    def timestamp(self):
+        return self.index['timestamp']
+
+    def jpeg(self, i):
+        """JPEG bytes of frame ``i`` as a zero-copy view into the mapped shard."""
+        record = self.index[i]
+        start = int(record['offset'])
+        return self._data[record['shard']][start:start + int(record['length'])]
+
+    def image(self, i, flags=cv2.IMREAD_COLOR):
+        """Decode frame ``i`` (BGR, like cv2.imread)."""
+        return cv2.imdecode(self.jpeg(i), flags)
+
+    def subset(self, positions):
+        """A dataset with only the given frames (indices or a boolean mask), sharing the mapped data."""
+        return ShardDataset(self.folder, self._data, self.index[positions])
+
+
+def pack(folders, out, shard_size=SHARD_SIZE):
+    """Convert folders of recorded JPEGs into shards; returns the number of frames written."""
+    writer = ShardWriter(out, shard_size)
+    try:
+        for folder in folders:
+            for sample in list_samples(folder):
+                with open(sample.path, 'rb') as f:
+                    jpeg = f.read()
+                writer.write(sample.counter, sample.steering, parse_timestamp(sample.timestamp), jpeg)
+    finally:
+        writer.close()
+    return writer.frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack recorded drives into shards, or describe a shard folder.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack_cmd = commands.add_parser('pack', help="Convert folders of {counter}_{steering}_{timestamp}.jpg files")
+    pack_cmd.add_argument('folders', nargs='+')
+    pack_cmd.add_argument('--out', required=True, help="Shard folder to create or append to")
+    pack_cmd.add_argument('--shard-size', type=int, default=SHARD_SIZE >> 20, help="Shard size in MB")
+    info_cmd = commands.add_parser('info', help="Print a summary of a shard folder")
+    info_cmd.add_argument('folder')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        frames = pack(args.folders, args.out, args.shard_size << 20)
+        print(f"[OK] Packed {frames} frames into {args.out}")
+    else:
+        dataset = ShardDataset(args.folder)
+        print(f"{len(dataset)} frames in {len(dataset._data)} shards, "
+              f"{int(dataset.index['length'].sum()) / 1e6:.1f} MB of JPEG")
+        if len(dataset):
+            steering = dataset.steering
+            print(f"Steering: min {steering.min()}, max {steering.max()}, mean {steering.mean():.1f}, "
+                  f"{np.count_nonzero(steering == 0)} frames at 0")
+
+
+if __name__ == "__main__":
+    main()
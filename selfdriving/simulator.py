@@ -0,0 +1,274 @@
+"""A stand-in for the car: replays a recorded drive as the ESP32-CAM would stream it.
+
+    python -m selfdriving.simulator "12 Laps perfected new/forward_images" --fps 20
+    python 8_self_driving_model_deployment.py --host 127.0.0.1 --stream-port 8081
+
+serves the recorded JPEGs as ``multipart/x-mixed-replace`` on
+``http://HOST:STREAM_PORT/stream`` (same part format as
+5_self_driving.ino) and accepts commands on the command port like the
+firmware does: legacy 3-byte ``>bh`` packets as well as protocol v1
+frames (see ``selfdriving.protocol``), which are acked on request and
+watched by the same watchdog. Every command is logged with its arrival
+time, the newest frame that had been streamed by then and that frame's
+age, i.e. the frame-to-command latency through stream, decode,
+preprocess, inference and the command client. A summary is printed on
+exit and ``--log`` writes every command to a CSV file.
+
+Recorded frames were flipped by the recorder, so by default they are
+flipped back before streaming and the deployment script sees the same
+orientation as from the real camera.
+"""
+import argparse
+import csv
+import glob
+import os
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from selfdriving.dataset import list_samples
+from selfdriving.inference import LatencyStats
+from selfdriving.protocol import COMMAND, FLAG_ACK, FRAME_SIZE, LEGACY, MAGIC, WATCHDOG, decode, encode_ack
+from selfdriving.shards import ShardDataset
+
+STREAM_PORT = 8081  # The car uses 81, which needs root on most machines
+CMD_PORT = 8000
+FPS = 20.0
+BOUNDARY = 'frame'
+COMMAND_NAMES = {0: 'STOP', 1: 'FWD', 2: 'TURN'}
+
+
+def load_jpegs(folder, flip=True):
+    """JPEG bytes of every frame in a recorder or shard folder, in recording order."""
+    if glob.glob(os.path.join(folder, 'shard-*.idx')):
+        dataset = ShardDataset(folder)
+        jpegs = [bytes(dataset.jpeg(i)) for i in np.argsort(dataset.seq, kind='stable')]
+    else:
+        jpegs = []
+        for sample in list_samples(folder):
+            with open(sample.path, 'rb') as f:
+                jpegs.append(f.read())
+    if flip:
+        flipped = []
+        for jpeg in jpegs:
+            image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+            if image is not None:
+                flipped.append(cv2.imencode('.jpg', cv2.flip(image, 0))[1].tobytes())
+        jpegs = flipped
+    return jpegs
+
+
+class FakeCar:
+    """Stream and command servers of the car, run on background threads.
+
+    ``sent`` is the (frame number, monotonic time) of the newest frame
+    written to a stream client; ``commands`` lists every received command
+    as a dict.
+    """
+
+    def __init__(self, jpegs, fps=FPS, host='127.0.0.1', stream_port=STREAM_PORT, cmd_port=CMD_PORT,
+                 loop=True, verbose=True):
+        if not jpegs:
+            raise ValueError("No frames to stream")
+        self.jpegs = jpegs
+        self.fps = fps
+        self.loop = loop
+        self.verbose = verbose
+        self.sent = (0, None)
+        self.frames_sent = 0
+        self.heartbeats = 0
+        self.watchdog_stops = 0
+        self.commands = []
+        self.latency = LatencyStats()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        car = self
+
+        class StreamHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/stream':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+                self.end_headers()
+                try:
+                    car._stream(self.wfile)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        class CommandHandler(socketserver.BaseRequestHandler):
+            def recv_exact(self, size):
+                data = b''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise ConnectionError
+                    data += chunk
+                return data
+
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                framed = False  # Watchdog only runs for protocol v1 clients, as on the car
+                stopped = False  # By the watchdog; the next heartbeat's command is applied again
+                try:
+                    while not car._stopped.is_set():
+                        try:
+                            first = self.recv_exact(1)
+                        except socket.timeout:
+                            car._watchdog()
+                            self.request.settimeout(None)
+                            framed = False
+                            stopped = True
+                            continue
+                        if first[0] != MAGIC:
+                            code, value = LEGACY.unpack(first + self.recv_exact(LEGACY.size - 1))
+                            car._command(code, value)
+                            continue
+                        frame = decode(first + self.recv_exact(FRAME_SIZE - 1))
+                        if frame is None:
+                            continue
+                        if not framed:
+                            framed = True
+                            self.request.settimeout(WATCHDOG)
+                        if frame['flags'] & FLAG_ACK:
+                            micros = int(time.monotonic() * 1e6)
+                            self.request.sendall(encode_ack(frame['seq'], frame['stamp'], micros))
+                        if frame['type'] != COMMAND:
+                            car.heartbeats += 1
+                        if frame['type'] == COMMAND or stopped:
+                            car._command(frame['code'], frame['steering'], frame['seq'], frame['throttle'])
+                            stopped = False
+                except (ConnectionError, OSError):
+                    pass
+
+        self._stream_server = ThreadingHTTPServer((host, stream_port), StreamHandler)
+        self._cmd_server = socketserver.ThreadingTCPServer((host, cmd_port), CommandHandler)
+        self._stream_server.daemon_threads = self._cmd_server.daemon_threads = True
+        self._threads = []
+
+    @property
+    def stream_url(self):
+        host, port = self._stream_server.server_address[:2]
+        return f"http://{host}:{port}/stream"
+
+    def _stream(self, out):
+        interval = 1 / self.fps
+        next_time = time.monotonic()
+        while not self._stopped.is_set():
+            for jpeg in self.jpegs:
+                if self._stopped.is_set():
+                    return
+                out.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode())
+                out.write(jpeg)
+                out.write(b"\r\n")
+                out.flush()
+                with self._lock:
+                    self.frames_sent += 1
+                    self.sent = (self.frames_sent, time.monotonic())
+                next_time += interval
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_time = time.monotonic()  # Client is slower than fps, do not try to catch up
+            if not self.loop:
+                return
+
+    def _watchdog(self):
+        self.watchdog_stops += 1
+        if self.verbose:
+            print(f"[WARN] {datetime.now().isoformat(timespec='milliseconds')} no frame for {WATCHDOG:g} s, "
+                  "the car would stop now")
+
+    def _command(self, code, value, seq=None, throttle=None):
+        now = time.monotonic()
+        with self._lock:
+            frame, sent_at = self.sent
+        latency = None if sent_at is None else now - sent_at
+        if latency is not None:
+            self.latency.add(latency)
+        entry = {'time': datetime.now().isoformat(timespec='milliseconds'), 'command': COMMAND_NAMES.get(code, code),
+                 'value': value, 'throttle': throttle, 'seq': seq, 'frame': frame,
+                 'latency_ms': None if latency is None else latency * 1000}
+        self.commands.append(entry)
+        if self.verbose:
+            age = f"{entry['latency_ms']:.1f} ms" if latency is not None else "-"
+            print(f"[CMD] {entry['time']} {entry['command']} {value} (frame {frame}, {age})")
+
+    def start(self):
+        for server in (self._stream_server, self._cmd_server):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for server in (self._stream_server, self._cmd_server):
+            server.shutdown()
+            server.server_close()
+
+    def save_log(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['time', 'command', 'value', 'throttle', 'seq', 'frame', 'latency_ms'])
+            writer.writeheader()
+            writer.writerows(self.commands)
+
+    def summary(self):
+        p = self.latency.percentiles(50, 95, 99)
+        text = (f"{self.frames_sent} frames streamed, {len(self.commands)} commands and {self.heartbeats} heartbeats "
+                f"received, {self.watchdog_stops} watchdog stops")
+        if p['p50'] is not None:
+            text += f", frame-to-command p50 {p['p50']:.1f} ms, p95 {p['p95']:.1f} ms, p99 {p['p99']:.1f} ms"
+        return text
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded drive as a fake ESP32-CAM car.")
+    parser.add_argument('folder', help="Recorder folder or shard folder")
+    parser.add_argument('--fps', type=float, default=FPS)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--stream-port', type=int, default=STREAM_PORT)
+    parser.add_argument('--cmd-port', type=int, default=CMD_PORT)
+    parser.add_argument('--once', action='store_true', help="Stream the drive once instead of looping")
+    parser.add_argument('--no-flip', action='store_true', help="Frames are raw camera JPEGs (SAVE_RAW_JPEG)")
+    parser.add_argument('--log', help="CSV file for the received commands")
+    parser.add_argument('--quiet', action='store_true', help="Do not print every command")
+    args = parser.parse_args()
+
+    jpegs = load_jpegs(args.folder, flip=not args.no_flip)
+    car = FakeCar(jpegs, args.fps, args.host, args.stream_port, args.cmd_port,
+                  loop=not args.once, verbose=not args.quiet)
+    print(f"[OK] Streaming {len(jpegs)} frames at {args.fps:g} fps on {car.stream_url}, "
+          f"commands on port {args.cmd_port}. Ctrl+C to stop.")
+    with car:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print("[INFO]", car.summary())
+    if args.log:
+        car.save_log(args.log)
+        print(f"[OK] Command log saved to {args.log}")
+
+
+if __name__ == "__main__":
+    main()
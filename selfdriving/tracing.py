@@ -0,0 +1,133 @@
+"""Per-frame latency tracing for the driving loop.
+
+Every frame that makes it to a command gets one row of monotonic
+timestamps, one per stage, in a preallocated ring buffer:
+
+    tracer = Tracer(['received', 'decoded', 'picked', 'preprocessed', 'predicted', 'sent'])
+    tracer.record(frame.seq, received, decoded, picked, preprocessed, predicted, sent)
+
+Recording is a single row write, cheap enough to do on every frame. The
+time spent in each step (e.g. ``predicted`` = received by ``predicted``
+minus ``preprocessed``) and the total are summarized as p50/p95/p99 on
+demand: ``summary()`` for the console, ``save()`` for a JSON file and
+``serve()`` for a Prometheus-style ``/metrics`` endpoint.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+QUANTILES = (50, 95, 99)
+
+
+class Tracer:
+    """Ring buffer of the last ``size`` frames' stage timestamps (monotonic seconds)."""
+
+    def __init__(self, stages, size=4096):
+        self.stages = tuple(stages)
+        self._stamps = np.zeros((size, len(self.stages)))
+        self._seq = np.zeros(size, np.int64)
+        self.count = 0
+
+    def record(self, seq, *stamps):
+        """Store one frame's timestamps, one per stage in order."""
+        row = self.count % len(self._seq)
+        self._seq[row] = seq
+        self._stamps[row] = stamps
+        self.count += 1
+
+    def rows(self):
+        """(seq, stamps) of the buffered frames, oldest first."""
+        n = min(self.count, len(self._seq))
+        order = (np.arange(n) + self.count - n) % len(self._seq)
+        return self._seq[order], self._stamps[order]
+
+    def durations(self):
+        """Seconds spent reaching each stage from the one before it, plus ``total``; {name: array}."""
+        _, stamps = self.rows()
+        steps = np.diff(stamps, axis=1)
+        result = {stage: steps[:, i] for i, stage in enumerate(self.stages[1:])}
+        result['total'] = stamps[:, -1] - stamps[:, 0]
+        return result
+
+    def percentiles(self, qs=QUANTILES):
+        """{step: {'count': n, 'p50': ms, ...}} over the buffered frames."""
+        report = {}
+        for name, values in self.durations().items():
+            entry = {'count': len(values)}
+            if len(values):
+                for q, v in zip(qs, np.percentile(values, qs) * 1000):
+                    entry[f'p{q}'] = float(v)
+            report[name] = entry
+        return report
+
+    def summary(self):
+        report = self.percentiles()
+        if not report['total']['count']:
+            return "no frames traced"
+        return ", ".join(f"{name} {r['p50']:.1f}/{r['p95']:.1f}/{r['p99']:.1f}" for name, r in report.items()) + \
+            f" ms (p50/p95/p99 over {report['total']['count']} frames)"
+
+    def save(self, path):
+        """Write the percentiles and the raw buffered rows to a JSON file."""
+        seq, stamps = self.rows()
+        with open(path, 'w') as f:
+            json.dump({
+                'stages': self.stages,
+                'percentiles_ms': self.percentiles(),
+                'frames': [[int(s), *row] for s, row in zip(seq, stamps.tolist())],
+            }, f)
+
+    def prometheus(self, prefix='selfdriving'):
+        """Percentiles in the Prometheus text exposition format (summary metrics, seconds)."""
+        lines = [f'# HELP {prefix}_stage_seconds Time from the previous stage to this one, per frame.',
+                 f'# TYPE {prefix}_stage_seconds summary']
+        for name, values in self.durations().items():
+            if len(values):
+                for q, v in zip(QUANTILES, np.percentile(values, QUANTILES)):
+                    lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{q / 100:g}"}} {v:.6f}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {float(np.sum(values)):.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {len(values)}')
+        lines.append(f'{prefix}_frames_total {self.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve ``prometheus()`` on http://host:port/metrics from a daemon thread; returns the server."""
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class Every:
+    """True at most once per ``seconds``, for occasional status lines in tight loops."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._next = time.monotonic() + seconds
+
+    def __call__(self):
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.seconds
+        return True